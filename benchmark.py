@@ -0,0 +1,280 @@
+"""Performance benchmarks of extraction, training, ranking and export.
+
+The benchmarks run on synthetic data, generated under --bench_dir at the scale
+given by the --bench_* flags: GBK query files in the format of data/, and a
+baike DB in the format of entitydb.py. Timings are written as JSON, so that
+runs on different commits can be compared:
+
+  python benchmark.py --bench_output=before.json
+  git checkout ...
+  python benchmark.py --bench_output=after.json
+  python benchmark.py --bench_compare=before.json,after.json
+
+Each benchmark is run --bench_repeats times, with a fresh entity DB cache, and
+the best and median times are reported.
+"""
+
+import datetime
+import entitydb
+import export_result
+import extractors
+import gflags
+import io
+import json
+import models
+import numpy
+import os
+import random
+import settings
+import sqlite3
+import subprocess
+import tabulate
+import timeit
+import utils
+from os import path
+
+gflags.DEFINE_string("bench_dir", "benchmark_data",
+                     "Directory of the synthetic data of the benchmarks.")
+gflags.DEFINE_integer("bench_queries", 200, "Number of queries per subtask.")
+gflags.DEFINE_integer("bench_candidates", 50, "Number of candidates per query.")
+gflags.DEFINE_integer("bench_content_length", 2000,
+                      "Average number of characters of an entity content.")
+gflags.DEFINE_integer("bench_seed", 0, "Seed of the synthetic data.")
+gflags.DEFINE_integer("bench_repeats", 3, "Number of runs of each benchmark.")
+gflags.DEFINE_string("bench_extractors", "nchar,char,nsumchar,sumchar,cont_bigram,cont_match",
+                     "Extractors of the benchmarked model.")
+gflags.DEFINE_string("bench_output", "", "When set, results are written to this JSON file.")
+gflags.DEFINE_string("bench_compare", "",
+                     "Two comma separated result files to compare, instead of "
+                     "running the benchmarks.")
+gflags.DEFINE_float("bench_regression_threshold", 1.1,
+                    "Slowdown ratio reported as a regression by --bench_compare.")
+
+# Common CJK characters, all of which GBK can encode.
+_CHARS = [unichr(c) for c in range(0x4e00, 0x4e00 + 3000)]
+
+
+class SyntheticData(object):
+  """Generates a baike DB and query files with a known scale.
+
+  Each query is made of characters of one of its candidates, which is labeled
+  as a match, so that extractors and models have something to learn.
+  """
+
+  def __init__(self, bench_dir, n_queries, n_candidates, content_length, seed=0):
+    self.bench_dir = bench_dir
+    self.n_queries = n_queries
+    self.n_candidates = n_candidates
+    self.content_length = content_length
+    self.seed = seed
+    self.rdm = random.Random(seed)
+
+  def _Text(self, length):
+    return u''.join(self.rdm.choice(_CHARS) for i in range(length))
+
+  def DataLoc(self, subtask, kind):
+    return path.join(self.bench_dir, "%s.%s.txt" % (subtask, kind))
+
+  @property
+  def db_loc(self):
+    return path.join(self.bench_dir, "baike.db")
+
+  def Config(self):
+    return {"queries" : self.n_queries,
+            "candidates" : self.n_candidates,
+            "content_length" : self.content_length,
+            "seed" : self.seed}
+
+  def Generate(self):
+    """Writes the data, unless data of the same configuration is already there."""
+    config_loc = path.join(self.bench_dir, "config.json")
+    if path.isfile(config_loc):
+      with open(config_loc) as infile:
+        if json.load(infile) == self.Config():
+          return
+    utils.mkdir_p(self.bench_dir)
+    entities = set()
+    for subtask in settings.sub_tasks:
+      train_lines = []
+      test_lines = []
+      for i in range(self.n_queries):
+        candidates = [self._Text(self.rdm.randint(2, 8)) for j in range(self.n_candidates)]
+        entities.update(candidates)
+        match = self.rdm.randrange(len(candidates))
+        query = u''.join(self.rdm.sample(candidates[match], min(3, len(candidates[match]))))
+        train_lines.append(u'\t'.join(
+            [query] + [u'%s:%d' % (c, int(j == match)) for j, c in enumerate(candidates)]))
+        test_lines.append(u'\t'.join([query] + candidates))
+      for kind, lines in [("train", train_lines), ("test", test_lines)]:
+        with io.open(self.DataLoc(subtask, kind), "w", encoding="gbk") as ofile:
+          ofile.write(u'\n'.join(lines) + u'\n')
+
+    if path.isfile(self.db_loc):
+      # Not a DB to keep: it is only written by this class.
+      os.remove(self.db_loc)
+    connection = sqlite3.connect(self.db_loc)
+    connection.executescript("""
+      CREATE TABLE entities(entity_name NUM, title NUM, link NUM, summary TEXT, content TEXT);
+      CREATE UNIQUE INDEX entity_name on entities(entity_name);
+    """)
+    rows = []
+    for entity in sorted(entities):
+      length = self.rdm.randint(self.content_length / 2, self.content_length * 3 / 2)
+      content = self._Text(length) + entity
+      rows.append((entity, entity, u'/view/%d.htm' % len(rows), content[:80], content))
+    connection.executemany("insert into entities values (?, ?, ?, ?, ?)", rows)
+    connection.commit()
+    with open(config_loc, "w") as ofile:
+      json.dump(self.Config(), ofile)
+
+
+def _ResetCaches():
+  entitydb.EntityDB.the_db = None
+
+
+def _Time(func, repeats):
+  """Runs func repeats times, each after resetting the caches.
+
+  Returns:
+    (sorted durations in seconds, result of the last run)
+  """
+  durations = []
+  result = None
+  for i in range(repeats):
+    _ResetCaches()
+    start = timeit.default_timer()
+    result = func()
+    durations.append(timeit.default_timer() - start)
+  return sorted(durations), result
+
+
+def _Summary(durations, n_items=None):
+  summary = {"best_s" : durations[0], "median_s" : float(numpy.median(durations))}
+  if n_items:
+    summary["items"] = n_items
+    summary["items_per_s"] = n_items / durations[0]
+  return summary
+
+
+def RunBenchmarks(data, extractors_name, repeats):
+  """Returns dict from benchmark name to its timings."""
+  train_data = dict((t, utils.LoadInData(data.DataLoc(t, "train"))) for t in settings.sub_tasks)
+  q_types, queries, entities, Y = [], [], [], []
+  for subtask, subtask_data in sorted(train_data.iteritems()):
+    for query, entity_info_list in subtask_data:
+      for ent, gs in entity_info_list:
+        q_types.append(subtask)
+        queries.append(query)
+        entities.append(ent)
+        Y.append(int(gs))
+  n_pairs = len(entities)
+  n_queries = sum(len(d) for d in train_data.itervalues())
+  results = {}
+
+  durations, builder = _Time(
+      lambda: extractors.ExtractBatch(extractors_name, q_types, queries, entities), repeats)
+  results["extract"] = _Summary(durations, n_pairs)
+
+  def Fit():
+    vectorizer = models.BuildDictVectorizer(builder.names)
+    return models.LogisticModel.FromFeatures(
+        extractors_name, models.VectorizeBatch(vectorizer, builder), numpy.array(Y),
+        vectorizer, builder.names)
+  durations, model = _Time(Fit, repeats)
+  results["fit"] = _Summary(durations, n_pairs)
+
+  def RankEach():
+    latencies = []
+    for subtask, subtask_data in sorted(train_data.iteritems()):
+      for query, entity_info_list in subtask_data:
+        start = timeit.default_timer()
+        model.RankByModelProb((subtask, query), [e for e, _ in entity_info_list])
+        latencies.append(timeit.default_timer() - start)
+    return latencies
+  durations, latencies = _Time(RankEach, repeats)
+  results["rank_by_model_prob"] = _Summary(durations, n_queries)
+  results["rank_by_model_prob"]["p50_ms"] = float(numpy.percentile(latencies, 50)) * 1000
+  results["rank_by_model_prob"]["p99_ms"] = float(numpy.percentile(latencies, 99)) * 1000
+
+  # Scores are computed once, so that only the evaluation itself is timed.
+  scores = dict((t, model.ScoreQueries([((t, q), [e for e, _ in entries])
+                                        for q, entries in subtask_data]))
+                for t, subtask_data in train_data.iteritems())
+  durations, _ = _Time(
+      lambda: model.EvaluateOn(train_data, seed=random.Random(0), scores=scores), repeats)
+  results["evaluate_map"] = _Summary(durations, n_queries)
+
+  output_dir = path.join(data.bench_dir, "output")
+  utils.mkdir_p(output_dir)
+  data_locs = dict((t, data.DataLoc(t, "test")) for t in settings.sub_tasks)
+  output_locs = dict((t, path.join(output_dir, t + ".txt")) for t in settings.sub_tasks)
+  durations, _ = _Time(
+      lambda: export_result.ExportResults(model, data_locs, output_locs, {}), repeats)
+  results["export"] = _Summary(durations, n_queries)
+  return results
+
+
+def _GitCommit():
+  try:
+    return subprocess.check_output(
+        ["git", "rev-parse", "HEAD"], cwd=path.dirname(path.abspath(__file__)),
+        stderr=open(os.devnull, "w")).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def CompareResults(old, new, threshold):
+  """Prints the best times of two result files, flagging regressions."""
+  rows = []
+  for name in sorted(set(old["results"]) | set(new["results"])):
+    if name not in old["results"] or name not in new["results"]:
+      rows.append([name, old["results"].get(name, {}).get("best_s"),
+                   new["results"].get(name, {}).get("best_s"), None, ""])
+      continue
+    old_s = old["results"][name]["best_s"]
+    new_s = new["results"][name]["best_s"]
+    ratio = new_s / old_s if old_s > 0 else float("inf")
+    rows.append([name, "%.4f" % old_s, "%.4f" % new_s, "%.2f" % ratio,
+                 "REGRESSION" if ratio > threshold else ""])
+  if old.get("config") != new.get("config"):
+    print "Warning: the runs have different configurations."
+  print tabulate.tabulate(rows, headers=["benchmark", "old (s)", "new (s)", "new/old", ""])
+
+
+def main():
+  utils.Initialize()
+  if gflags.FLAGS.bench_compare:
+    old_loc, new_loc = gflags.FLAGS.bench_compare.split(",")
+    with open(old_loc) as old_file, open(new_loc) as new_file:
+      CompareResults(json.load(old_file), json.load(new_file),
+                     gflags.FLAGS.bench_regression_threshold)
+    return
+
+  data = SyntheticData(gflags.FLAGS.bench_dir, gflags.FLAGS.bench_queries,
+                       gflags.FLAGS.bench_candidates, gflags.FLAGS.bench_content_length,
+                       gflags.FLAGS.bench_seed)
+  data.Generate()
+  gflags.FLAGS.baike_db_loc = data.db_loc
+  # Parsed data caches stay with the data, out of the working directory.
+  gflags.FLAGS.data_cache_dir = path.join(data.bench_dir, "data_cache")
+  _ResetCaches()
+
+  config = data.Config()
+  config["extractors"] = gflags.FLAGS.bench_extractors
+  config["repeats"] = gflags.FLAGS.bench_repeats
+  output = {"config" : config,
+            "commit" : _GitCommit(),
+            "timestamp" : str(datetime.datetime.now()),
+            "results" : RunBenchmarks(data, gflags.FLAGS.bench_extractors,
+                                      gflags.FLAGS.bench_repeats)}
+  rows = [[name, "%.4f" % r["best_s"], "%.4f" % r["median_s"],
+           "%.1f" % r["items_per_s"] if "items_per_s" in r else ""]
+          for name, r in sorted(output["results"].iteritems())]
+  print tabulate.tabulate(rows, headers=["benchmark", "best (s)", "median (s)", "items/s"])
+  if gflags.FLAGS.bench_output:
+    with open(gflags.FLAGS.bench_output, "w") as ofile:
+      json.dump(output, ofile, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,85 @@
+"""Measuring the MAP and latency of cascade models at several shortlist sizes.
+
+A first-stage model is trained on the cheap --cascade_extractors, and a full
+model on --extractors, both on the cross validation data. For every size of
+--cascade_shortlists, the cascade of the two (see models.CascadeModel) ranks
+the held-out queries one at a time, starting from a cold entity cache. The MAP
+loss and the speedup against the full model alone tell which size to use.
+
+Example:
+  python cascade.py --cascade_shortlists=5,10,20,50 \
+      --cascade_model_loc=models/cascade.model --cascade_save_shortlist=20
+"""
+
+import gflags
+import numpy
+import random
+import tabulate
+import timeit
+import entitydb
+import features
+import models
+import run_experiment
+import utils
+
+gflags.DEFINE_string("cascade_extractors", "nchar,char,2gsurf",
+                     "Extractors of the first stage, which only look at the "
+                     "entity name.")
+gflags.DEFINE_string("cascade_shortlists", "5,10,20,50",
+                     "Comma separated shortlist sizes to measure.")
+gflags.DEFINE_string("cascade_model_loc", "",
+                     "When set, the cascade with --cascade_save_shortlist is "
+                     "saved there, to be used like any other model.")
+gflags.DEFINE_integer("cascade_save_shortlist", 20, "Shortlist size of the saved cascade.")
+
+
+def MeasureLatency(model, data):
+  """Ranks the queries one at a time, from a cold entity cache.
+
+  Returns:
+    latency of each query, in seconds.
+  """
+  entitydb.EntityDB.the_db = None
+  latencies = []
+  for subtask, subtask_data in sorted(data.iteritems()):
+    for query, entity_info_list in subtask_data:
+      start = timeit.default_timer()
+      model.RankQueries([((subtask, query), [e for e, _ in entity_info_list])])
+      latencies.append(timeit.default_timer() - start)
+  return latencies
+
+
+def main():
+  utils.Initialize()
+  cv_data = run_experiment.LoadCVData()
+  hd_data = run_experiment.LoadHDData()
+  table = features.FeatureTable(gflags.FLAGS.extractors, cv_data)
+  model = table.datasets[0].TrainModel()
+  first_stage = table.Select(gflags.FLAGS.cascade_extractors).datasets[0].TrainModel()
+
+  candidates = [(None, model)]
+  for size in [int(s) for s in gflags.FLAGS.cascade_shortlists.split(",")]:
+    candidates.append((size, models.CascadeModel(first_stage, model, size)))
+
+  rows = []
+  full_map = full_latency = None
+  for size, candidate in candidates:
+    latencies = MeasureLatency(candidate, hd_data)
+    score = candidate.EvaluateOn(hd_data, seed=random.Random(0))["score"]
+    latency = numpy.mean(latencies)
+    if size is None:
+      full_map, full_latency = score, latency
+    rows.append(["full" if size is None else size, "%.4f" % score,
+                 "%+.4f" % (score - full_map), "%.2f" % (latency * 1000),
+                 "%.2f" % (numpy.percentile(latencies, 99) * 1000),
+                 "%.2fx" % (full_latency / latency)])
+  print tabulate.tabulate(rows, headers=[
+      "shortlist", "held-out MAP", "MAP change", "mean ms/query", "p99 ms/query", "speedup"])
+
+  if gflags.FLAGS.cascade_model_loc:
+    models.CascadeModel(first_stage, model, gflags.FLAGS.cascade_save_shortlist).Save(
+        gflags.FLAGS.cascade_model_loc)
+
+
+if __name__ == "__main__":
+  main()
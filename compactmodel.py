@@ -0,0 +1,281 @@
+"""Compact, memory mapped models, scored with NumPy only.
+
+A LogisticModel saved with joblib takes long to load: unpickling it imports
+sklearn, and rebuilds the vocabulary of its DictVectorizer as a Python dict. A
+compact model holds the same coefficients and feature names in a single file,
+which is memory mapped, so it loads in milliseconds and processes reading it
+share its pages. CompactModel scores and ranks exactly like the LogisticModel
+it was written from, without importing sklearn or scipy.
+
+run_experiment.py writes the compact model next to the joblib one. Older models
+are converted with:
+  python compactmodel.py --convert_model_loc=models/101.model
+"""
+
+import gflags
+import hashlib
+import mmap
+import numpy
+import os
+import struct
+import evaluation
+import extractors
+import utils
+from os import path
+
+gflags.DEFINE_string("convert_model_loc", "",
+                     "Model to write as a compact model, next to it.")
+
+# File layout of a compact model. All integers are little endian, and arrays
+# are 8-byte aligned.
+#   header: magic, vectorizer kind, whether hashed features have signs, hash
+#     width, number of columns n, intercept, length of the extractors name,
+#     number of feature names m, then the offsets of the sections below.
+#   extractors: UTF-8 comma separated extractor names.
+#   coef: n float64, the coefficient of each column.
+#   For _DICT models only, the vocabulary, sorted by name hash (see _NameHash):
+#     hashes: m uint64, sorted name hash of each feature.
+#     columns: m int64, column of each feature.
+#     name_offsets: m + 1 uint64, start of each name in names.
+#     names: UTF-8 feature names.
+_MAGIC = "CMODEL01"
+_HEADER = struct.Struct("<8sIIQQdQQQQQQQ")
+_DICT = 0
+_HASH = 1
+
+
+def CompactLoc(model_loc):
+  """Location of the compact model of a joblib model."""
+  return path.splitext(model_loc)[0] + ".cmodel"
+
+
+def _Encode(name):
+  return name.encode('utf8') if isinstance(name, unicode) else name
+
+
+def _NameHash(name):
+  return numpy.uint64(struct.unpack("<Q", hashlib.md5(name).digest()[:8])[0])
+
+
+def _Murmurhash3(key, seed=0):
+  """MurmurHash3_x86_32 of a byte string, as a signed int, like
+  sklearn.utils.murmurhash3_32."""
+  length = len(key)
+  h = seed & 0xffffffff
+  c1 = 0xcc9e2d51
+  c2 = 0x1b873593
+  n_blocks = length // 4
+  for i in xrange(n_blocks):
+    (k,) = struct.unpack_from("<I", key, 4 * i)
+    k = (k * c1) & 0xffffffff
+    k = ((k << 15) | (k >> 17)) & 0xffffffff
+    k = (k * c2) & 0xffffffff
+    h ^= k
+    h = ((h << 13) | (h >> 19)) & 0xffffffff
+    h = (h * 5 + 0xe6546b64) & 0xffffffff
+
+  k = 0
+  tail = key[4 * n_blocks:]
+  for i in reversed(range(len(tail))):
+    k = (k << 8) | ord(tail[i])
+  if tail:
+    k = (k * c1) & 0xffffffff
+    k = ((k << 15) | (k >> 17)) & 0xffffffff
+    k = (k * c2) & 0xffffffff
+    h ^= k
+
+  h ^= length
+  h ^= h >> 16
+  h = (h * 0x85ebca6b) & 0xffffffff
+  h ^= h >> 13
+  h = (h * 0xc2b2ae35) & 0xffffffff
+  h ^= h >> 16
+  return h - (1 << 32) if h & 0x80000000 else h
+
+
+class CompactModel(object):
+  """Read-only model reading a file written by Write.
+
+  It has the scoring and ranking methods of models.LogisticModel.
+  """
+
+  def __init__(self, model_loc):
+    self.model_loc = model_loc
+    with open(model_loc, "rb") as infile:
+      self.data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+    (magic, self.kind, alternate_sign, self.hash_width, n_columns, self.intercept,
+     extractors_len, self.n_names, extractors_start, coef_start, hashes_start,
+     columns_start, name_offsets_start) = _HEADER.unpack_from(self.data)
+    if magic != _MAGIC:
+      raise ValueError("%s is not a compact model" % model_loc)
+    self.alternate_sign = bool(alternate_sign)
+    self.extractors_name = self.data[
+        extractors_start:extractors_start + extractors_len].decode('utf8')
+    self.coef = numpy.frombuffer(self.data, '<f8', n_columns, coef_start)
+    if self.kind == _DICT:
+      self.hashes = numpy.frombuffer(self.data, '<u8', self.n_names, hashes_start)
+      self.columns = numpy.frombuffer(self.data, '<i8', self.n_names, columns_start)
+      self.name_offsets = numpy.frombuffer(
+          self.data, '<u8', self.n_names + 1, name_offsets_start)
+      self.names_start = name_offsets_start + 8 * (self.n_names + 1)
+
+  def _Name(self, i):
+    return self.data[self.names_start + int(self.name_offsets[i]):
+                     self.names_start + int(self.name_offsets[i + 1])]
+
+  def _Column(self, name):
+    """Returns (column, sign) of a feature, column -1 if the model lacks it."""
+    key = _Encode(name)
+    if self.kind == _HASH:
+      h = _Murmurhash3(key)
+      sign = 1 if (h >= 0 or not self.alternate_sign) else -1
+      return abs(h) % self.hash_width, sign
+    key_hash = _NameHash(key)
+    i = int(numpy.searchsorted(self.hashes, key_hash))
+    while i < self.n_names and self.hashes[i] == key_hash:
+      if self._Name(i) == key:
+        return int(self.columns[i]), 1
+      i += 1
+    return -1, 1
+
+  def ScoreBuilder(self, builder):
+    """Match probabilities of the pairs of an extractors.FeatureMatrixBuilder.
+
+    Computed in the same order as LogisticModel.ScoreMatrix(VectorizeBatch()),
+    so that probabilities are equal to the last bit.
+    """
+    rows, cols, values = builder.Entries()
+    columns = numpy.zeros(len(builder.names), dtype=int)
+    signs = numpy.ones(len(builder.names))
+    for i, name in enumerate(builder.names):
+      columns[i], signs[i] = self._Column(name)
+    values = values * signs[cols]
+    cols = columns[cols]
+    if self.kind == _HASH:
+      # Features hashed into the same column are summed first, in the order
+      # of the entries, and sums that cancel out are dropped.
+      order = numpy.lexsort((numpy.arange(len(rows)), cols, rows))
+      rows, cols, values = rows[order], cols[order], values[order]
+      starts = numpy.ones(len(rows), dtype=bool)
+      starts[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+      values = numpy.bincount(numpy.cumsum(starts) - 1, weights=values,
+                              minlength=starts.sum())
+      rows, cols = rows[starts], cols[starts]
+      keep = values != 0
+    else:
+      keep = (cols >= 0) & (values != 0)
+    rows, cols, values = rows[keep], cols[keep], values[keep]
+    order = numpy.lexsort((cols, rows))
+    rows, cols, values = rows[order], cols[order], values[order]
+    decision = numpy.bincount(rows, weights=values * self.coef[cols],
+                              minlength=builder.n_rows) + self.intercept
+    probs = 1.0 / (1.0 + numpy.exp(-decision))
+    # predict_proba normalizes the probabilities of both classes.
+    return probs / ((1 - probs) + probs)
+
+  def ScoreQueries(self, queries):
+    """Same as LogisticModel.ScoreQueries."""
+    q_types = []
+    q_list = []
+    entities = []
+    offsets = [0]
+    for (subtask, q), results in queries:
+      q_types.extend([subtask] * len(results))
+      q_list.extend([q] * len(results))
+      entities.extend(results)
+      offsets.append(len(entities))
+    builder = extractors.ExtractBatch(self.extractors_name, q_types, q_list, entities)
+    probs = self.ScoreBuilder(builder)
+    return [probs[s:e] for s, e in zip(offsets[:-1], offsets[1:])]
+
+  def ScoreCandidates(self, (subtask, q), results):
+    return self.ScoreQueries([((subtask, q), results)])[0]
+
+  def ScoreByModel(self, (subtask, q), r):
+    return self.ScoreCandidates((subtask, q), [r])[0]
+
+  def RankQueries(self, queries):
+    """Same as LogisticModel.RankQueries."""
+    scores = self.ScoreQueries(queries)
+    offsets = numpy.cumsum([0] + [len(results) for _, results in queries])
+    entities = [e for _, results in queries for e in results]
+    if len(entities) == 0:
+      return [[] for _ in queries]
+    order = evaluation.RankOrder(offsets, numpy.concatenate(scores),
+                                 evaluation.EntityKeys(entities))
+    return [[entities[i] for i in order[s:e]] for s, e in zip(offsets[:-1], offsets[1:])]
+
+  def RankTopK(self, queries, k):
+    """Same as LogisticModel.RankTopK."""
+    if not isinstance(k, list):
+      k = [k] * len(queries)
+    return [[results[i] for i in evaluation.TopKOrder(scores, results, query_k)]
+            for (_, results), scores, query_k in zip(queries, self.ScoreQueries(queries), k)]
+
+  def RankByModelProb(self, (subtask, q), results):
+    return self.RankQueries([((subtask, q), results)])[0]
+
+
+def Write(model, model_loc):
+  """Writes a models.LogisticModel as a compact model.
+
+  Raises:
+    ValueError: when model is not a LogisticModel, such as a CascadeModel.
+  """
+  # Only writing needs sklearn, which models imports.
+  import models
+  if not isinstance(model, models.LogisticModel):
+    raise ValueError("Only a LogisticModel can be compacted, not a %s" % (
+        type(model).__name__))
+  logistic_model = model.logistic_model
+  if list(logistic_model.classes_) != [0, 1]:
+    raise ValueError("Only models of 0/1 labels can be compacted, not %s" % (
+        list(logistic_model.classes_),))
+  coef = numpy.asarray(logistic_model.coef_[0], dtype='<f8')
+  vectorizer = model.vectorizer
+  if hasattr(vectorizer, "vocabulary_"):
+    kind, hash_width, alternate_sign = _DICT, 0, False
+    names = sorted((_NameHash(_Encode(name)), _Encode(name), col)
+                   for name, col in vectorizer.vocabulary_.iteritems())
+  else:
+    kind, hash_width, alternate_sign = _HASH, vectorizer.n_features, vectorizer.alternate_sign
+    names = []
+  extractors_name = model.extractors_name.encode('utf8')
+
+  tmp_loc = model_loc + ".tmp"
+  with open(tmp_loc, "wb") as ofile:
+    ofile.write("\0" * _HEADER.size)
+    extractors_start = ofile.tell()
+    ofile.write(extractors_name)
+    ofile.write("\0" * (-ofile.tell() % 8))
+    coef_start = ofile.tell()
+    ofile.write(coef.tobytes())
+    hashes_start = ofile.tell()
+    ofile.write(numpy.array([h for h, name, col in names], dtype='<u8').tobytes())
+    columns_start = ofile.tell()
+    ofile.write(numpy.array([col for h, name, col in names], dtype='<i8').tobytes())
+    name_offsets_start = ofile.tell()
+    name_offsets = numpy.zeros(len(names) + 1, dtype='<u8')
+    numpy.cumsum([len(name) for h, name, col in names], out=name_offsets[1:])
+    ofile.write(name_offsets.tobytes())
+    for h, name, col in names:
+      ofile.write(name)
+    ofile.seek(0)
+    ofile.write(_HEADER.pack(
+        _MAGIC, kind, alternate_sign, hash_width, len(coef),
+        float(logistic_model.intercept_[0]), len(extractors_name), len(names),
+        extractors_start, coef_start, hashes_start, columns_start, name_offsets_start))
+  os.rename(tmp_loc, model_loc)
+
+
+def main():
+  utils.Initialize()
+  # Only converting needs sklearn, to unpickle the model.
+  import models
+  model_loc = gflags.FLAGS.convert_model_loc
+  Write(models.LogisticModel.LoadFrom(model_loc), CompactLoc(model_loc))
+  print "Wrote %s" % CompactLoc(model_loc)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,234 @@
+"""Binary cache of parsed query data files.
+
+Parsing the GBK data files dominates the start-up of experiments and exports.
+LoadData converts a data file once into columnar arrays, under
+--data_cache_dir, and memory maps them afterwards:
+
+  strings, string_offsets: UTF-8 blob and offsets of the distinct queries and
+    entities, each stored once.
+  query_ids: int32 string id of each query.
+  entry_offsets: int64 start of the entities of each query.
+  entity_ids: int32 string id of each entity.
+  labels: int8 score of each entity, _NO_LABEL for test data.
+  meta.json: size, mtime and sha1 of the source file.
+
+Arrays are raw little endian files, written while the source file is parsed,
+so that building an entry only keeps the distinct strings in memory.
+
+A cache entry is checked against the size and mtime of its source file at each
+load. When the mtime changed, the file is hashed, and the cache is rebuilt only
+if its content changed.
+"""
+
+import collections
+import gflags
+import hashlib
+import json
+import numpy
+import os
+import shutil
+import tempfile
+import utils
+from os import path
+
+gflags.DEFINE_string("data_cache_dir", "data_cache",
+                     "Directory to cache parsed data files. Empty to disable.")
+
+_VERSION = 2
+_NO_LABEL = -128
+_ARRAYS = {"string_offsets" : "<i8",
+           "query_ids" : "<i4",
+           "entry_offsets" : "<i8",
+           "entity_ids" : "<i4",
+           "labels" : "i1"}
+# Number of decoded strings a Dataset keeps, least recently used dropped first.
+_DECODED_CACHE_SIZE = 20000
+
+
+def _LoadArray(loc, dtype):
+  if path.getsize(loc) == 0:
+    # Empty files can't be memory mapped.
+    return numpy.zeros(0, dtype=dtype)
+  return numpy.memmap(loc, dtype=dtype, mode="r")
+
+
+class Dataset(object):
+  """Read-only sequence of (query, [(entity, score), ...]), like utils.LoadInData."""
+
+  def __init__(self, cache_loc):
+    for name, dtype in _ARRAYS.iteritems():
+      setattr(self, name, _LoadArray(path.join(cache_loc, name), dtype))
+    self.strings = _LoadArray(path.join(cache_loc, "strings"), numpy.uint8)
+    # Recently decoded strings, by id. Entities are shared by many queries.
+    self.decoded = collections.OrderedDict()
+
+  def _String(self, string_id):
+    try:
+      text = self.decoded.pop(string_id)
+    except KeyError:
+      start, end = self.string_offsets[string_id:string_id + 2]
+      text = self.strings[start:end].tobytes().decode('utf8')
+    self.decoded[string_id] = text
+    if len(self.decoded) > _DECODED_CACHE_SIZE:
+      self.decoded.popitem(last=False)
+    return text
+
+  def __len__(self):
+    return len(self.query_ids)
+
+  def __getitem__(self, i):
+    if i < 0:
+      i += len(self)
+    if not 0 <= i < len(self):
+      raise IndexError(i)
+    start, end = self.entry_offsets[i:i + 2]
+    entries = [(self._String(e), None if l == _NO_LABEL else int(l))
+               for e, l in zip(self.entity_ids[start:end].tolist(),
+                               self.labels[start:end].tolist())]
+    return (self._String(int(self.query_ids[i])), entries)
+
+  def __iter__(self):
+    for i in xrange(len(self)):
+      yield self[i]
+
+
+def _FileHash(data_loc):
+  h = hashlib.sha1()
+  with open(data_loc, "rb") as infile:
+    for block in iter(lambda: infile.read(1 << 20), ""):
+      h.update(block)
+  return h.hexdigest()
+
+
+def _SourceMeta(data_loc, test_data, with_hash=False):
+  stat = os.stat(data_loc)
+  meta = {"version" : _VERSION,
+          "source" : path.abspath(data_loc),
+          "test_data" : test_data,
+          "size" : stat.st_size,
+          "mtime" : stat.st_mtime}
+  if with_hash:
+    meta["sha1"] = _FileHash(data_loc)
+  return meta
+
+
+def _WriteMeta(cache_loc, meta):
+  tmp_loc = path.join(cache_loc, "meta.json.tmp")
+  with open(tmp_loc, "w") as ofile:
+    json.dump(meta, ofile)
+  os.rename(tmp_loc, path.join(cache_loc, "meta.json"))
+
+
+def _IsValid(cache_loc, data_loc, test_data):
+  """Whether the cache entry is built from the current content of data_loc."""
+  try:
+    with open(path.join(cache_loc, "meta.json")) as infile:
+      cached = json.load(infile)
+  except (IOError, ValueError):
+    return False
+  meta = _SourceMeta(data_loc, test_data)
+  for key in ["version", "test_data", "size"]:
+    if cached.get(key) != meta[key]:
+      return False
+  if cached["mtime"] == meta["mtime"]:
+    return True
+  # The file was touched: it is still valid if the content didn't change.
+  meta["sha1"] = _FileHash(data_loc)
+  if cached.get("sha1") != meta["sha1"]:
+    return False
+  _WriteMeta(cache_loc, meta)
+  return True
+
+
+class _ArrayWriter(object):
+  """Appends values to a raw array file, a buffer at a time."""
+
+  _BUFFER_SIZE = 1 << 16
+
+  def __init__(self, loc, dtype):
+    self.ofile = open(loc, "wb")
+    self.dtype = dtype
+    self.buffer = []
+    self.size = 0
+
+  def Append(self, value):
+    self.buffer.append(value)
+    self.size += 1
+    if len(self.buffer) >= self._BUFFER_SIZE:
+      self.Flush()
+
+  def Flush(self):
+    numpy.array(self.buffer, dtype=self.dtype).tofile(self.ofile)
+    self.buffer = []
+
+  def Close(self):
+    self.Flush()
+    self.ofile.close()
+
+
+def BuildCache(data_loc, test_data, cache_loc):
+  """Parses data_loc, and writes its arrays to cache_loc."""
+  meta = _SourceMeta(data_loc, test_data, with_hash=True)
+  utils.mkdir_p(path.dirname(cache_loc))
+  tmp_loc = tempfile.mkdtemp(dir=path.dirname(cache_loc))
+  writers = dict((name, _ArrayWriter(path.join(tmp_loc, name), dtype))
+                 for name, dtype in _ARRAYS.iteritems())
+  strings_file = open(path.join(tmp_loc, "strings"), "wb")
+  # Keyed by UTF-8 bytes, which take less memory than unicode strings.
+  string_ids = {}
+  string_offsets = writers["string_offsets"]
+  string_offsets.Append(0)
+
+  def Intern(text):
+    encoded = text.encode('utf8')
+    string_id = string_ids.get(encoded)
+    if string_id is None:
+      string_id = string_ids[encoded] = len(string_ids)
+      strings_file.write(encoded)
+      string_offsets.Append(strings_file.tell())
+    return string_id
+
+  writers["entry_offsets"].Append(0)
+  for query, entries in utils.IterData(data_loc, test_data):
+    writers["query_ids"].Append(Intern(query))
+    for entity, score in entries:
+      writers["entity_ids"].Append(Intern(entity))
+      if score is None:
+        writers["labels"].Append(_NO_LABEL)
+      elif _NO_LABEL < score <= 127:
+        writers["labels"].Append(score)
+      else:
+        raise ValueError("%s: score %d doesn't fit in the cache" % (data_loc, score))
+    writers["entry_offsets"].Append(writers["entity_ids"].size)
+  strings_file.close()
+  for writer in writers.itervalues():
+    writer.Close()
+
+  _WriteMeta(tmp_loc, meta)
+  if path.isdir(cache_loc):
+    shutil.rmtree(cache_loc, ignore_errors=True)
+  try:
+    os.rename(tmp_loc, cache_loc)
+  except OSError:
+    # Another process rebuilt the same entry first.
+    shutil.rmtree(tmp_loc)
+
+
+def LoadData(data_loc, test_data=False):
+  """Same as utils.LoadInData, loading a Dataset from the cache when possible."""
+  cache_dir = gflags.FLAGS.data_cache_dir
+  if not cache_dir:
+    return utils.LoadInData(data_loc, test_data)
+
+  key = hashlib.sha1("%s:%s" % (path.abspath(data_loc), test_data)).hexdigest()
+  cache_loc = path.join(cache_dir, key)
+  if not _IsValid(cache_loc, data_loc, test_data):
+    BuildCache(data_loc, test_data, cache_loc)
+  return Dataset(cache_loc)
+
+
+def IterData(data_loc, test_data=False):
+  """Same as utils.IterData, reading the cache when --data_cache_dir is set."""
+  if gflags.FLAGS.data_cache_dir:
+    return iter(LoadData(data_loc, test_data))
+  return utils.IterData(data_loc, test_data)
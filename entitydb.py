@@ -10,41 +10,106 @@ CREATE TABLE entities(
   content TEXT
 );
 CREATE UNIQUE INDEX entity_name on entities(entity_name);
+
+Rows are read once per entity, and kept in a bounded LRU cache (see
+--entity_cache_size), as every extractor looks up the same entities.
+
+EntityStore is a read-only alternative to the DB: a single file, memory mapped,
+holding the zlib compressed summary and content of every entity. Processes
+reading it share the OS page cache, and take no SQLite locks. It is built from
+the DB with:
+  python entitydb.py --baike_db_loc=entities_db/baike.db \
+      --entity_store_loc=entities_db/baike.store
+and used instead of the DB whenever --entity_store_loc is set.
 """
 
 
+import collections
 import gflags
+import hashlib
+import mmap
+import numpy
+import os
+import profiling
 import sqlite3
+import struct
+import sys
 import unicodecsv as csv
+import utils
+import zlib
 
 gflags.DEFINE_string("baike_db_loc", "entities_db/baike.db",
                      "SQLite3 database containing the baike data")
+gflags.DEFINE_integer("entity_cache_size", 20000,
+                      "Number of entities kept in the in-memory LRU cache of "
+                      "EntityDB. 0 disables caching.")
+gflags.DEFINE_string("entity_store_loc", "",
+                     "When set, entities are read from this file built by "
+                     "entitydb.py instead of --baike_db_loc.")
 
 class EntityDB(object):
 
   the_db = None
 
-  def __init__(self):
-    self.db_con = sqlite3.connect(gflags.FLAGS.baike_db_loc)
-    self.cursor = self.db_con.cursor()
+  def __init__(self, cache_size=None):
+    self._Open()
+    if profiling.Enabled():
+      # Entries are fetched on cache misses, so these are the DB queries.
+      self._FetchEntry = profiling.ProfileCalls(
+          "entitydb", type(self).__name__ + "._FetchEntry", self._FetchEntry)
+    if cache_size is None:
+      cache_size = gflags.FLAGS.entity_cache_size
+    self.cache_size = cache_size
+    self.cache = collections.OrderedDict()
+    self.cache_hits = 0
+    self.cache_misses = 0
 
   @staticmethod
   def GetTheDB():
     if EntityDB.the_db is None:
-      EntityDB.the_db = EntityDB()
+      if gflags.FLAGS.entity_store_loc:
+        EntityDB.the_db = EntityStore(gflags.FLAGS.entity_store_loc)
+      else:
+        EntityDB.the_db = EntityDB()
     return EntityDB.the_db
 
-  def _GetEntryByName(self, entity_name):
+  def _Open(self):
+    self.db_con = sqlite3.connect(gflags.FLAGS.baike_db_loc)
+    self.cursor = self.db_con.cursor()
+
+  def _FetchEntry(self, entity_name):
+    """Reads an entity row from the DB, or returns None if it is missing."""
     self.cursor.execute(
       "select entity_name, summary, content from entities where entity_name=?", (entity_name,))
     row = self.cursor.fetchone()
     if row is None:
-      raise IndexError
+      return None
     entity_name, summary, content = row
     return {"entity_name" : entity_name,
             "summary" : summary,
             "content" : content}
 
+  def _GetEntryByName(self, entity_name):
+    try:
+      entry = self.cache.pop(entity_name)
+      self.cache_hits += 1
+    except KeyError:
+      entry = self._FetchEntry(entity_name)
+      self.cache_misses += 1
+    if self.cache_size > 0:
+      # Missing entities are cached as None, so they are not looked up again.
+      self.cache[entity_name] = entry
+      if len(self.cache) > self.cache_size:
+        self.cache.popitem(last=False)
+    if entry is None:
+      raise IndexError
+    return entry
+
+  def CacheStats(self):
+    return {"hits" : self.cache_hits,
+            "misses" : self.cache_misses,
+            "size" : len(self.cache)}
+
   def LookupEntitySummary(self, entity_name):
     """Looks up entity summary only.
 
@@ -61,8 +126,153 @@ class EntityDB(object):
     return self._GetEntryByName(entity_name)["content"]
 
 
+# File layout of an EntityStore. All integers are little endian.
+#   header: magic, number of entities n, then the offsets of the sections below.
+#   records: for each entity, sorted by name hash (see _NameHash) then name:
+#     compressed lengths (int32, -1 for NULL) of its summary and content, then
+#     the zlib compressed UTF-8 texts.
+#   record_offsets: n + 1 uint64, start of each record, 8-byte aligned.
+#   hashes: n uint64, sorted name hash of each record.
+#   name_offsets: n + 1 uint64, start of each name in names.
+#   names: UTF-8 entity names of each record.
+_STORE_MAGIC = "ENTSTOR2"
+_STORE_HEADER = struct.Struct("<8sQQQQQ")
+_RECORD_HEADER = struct.Struct("<ii")
+
+
+class EntityStore(EntityDB):
+  """Read-only EntityDB reading a file written by BuildEntityStore."""
+
+  def __init__(self, store_loc, cache_size=None):
+    self.store_loc = store_loc
+    EntityDB.__init__(self, cache_size)
+
+  def _Open(self):
+    with open(self.store_loc, "rb") as infile:
+      self.data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+    (magic, self.n_entities, record_offsets_start, hashes_start,
+     name_offsets_start, self.names_start) = _STORE_HEADER.unpack_from(self.data)
+    if magic != _STORE_MAGIC:
+      raise ValueError("%s is not an entity store" % self.store_loc)
+    self.record_offsets = numpy.frombuffer(
+        self.data, '<u8', self.n_entities + 1, record_offsets_start)
+    self.hashes = numpy.frombuffer(self.data, '<u8', self.n_entities, hashes_start)
+    self.name_offsets = numpy.frombuffer(
+        self.data, '<u8', self.n_entities + 1, name_offsets_start)
+
+  def _Name(self, i):
+    return self.data[self.names_start + int(self.name_offsets[i]):
+                     self.names_start + int(self.name_offsets[i + 1])]
+
+  def _FetchEntry(self, entity_name):
+    key = unicode(entity_name).encode('utf8')
+    key_hash = _NameHash(key)
+    i = int(numpy.searchsorted(self.hashes, key_hash))
+    while i < self.n_entities and self.hashes[i] == key_hash:
+      if self._Name(i) == key:
+        return _StoreEntry(self.data, int(self.record_offsets[i]), entity_name)
+      i += 1
+    return None
+
+
+class _StoreEntry(dict):
+  """Entry of an EntityStore, decompressing a field when it is first read."""
+
+  _FIELDS = ("summary", "content")
+
+  def __init__(self, data, record_offset, entity_name):
+    dict.__init__(self, entity_name=entity_name)
+    self.data = data
+    lengths = _RECORD_HEADER.unpack_from(data, record_offset)
+    start = record_offset + _RECORD_HEADER.size
+    self.spans = {}
+    for field, length in zip(self._FIELDS, lengths):
+      self.spans[field] = (start, length)
+      start += max(length, 0)
+
+  def __missing__(self, field):
+    start, length = self.spans[field]
+    if length < 0:
+      text = None
+    else:
+      text = zlib.decompress(self.data[start:start + length]).decode('utf8')
+    self[field] = text
+    return text
+
+
+def _NameHash(name):
+  return numpy.uint64(struct.unpack("<Q", hashlib.md5(name).digest()[:8])[0])
+
+
+def BuildEntityStore(db_loc, store_loc):
+  """Writes the entities of the DB to an EntityStore file."""
+  connection = sqlite3.connect(db_loc)
+  # entity_name has NUM affinity, numeric looking names are read as numbers.
+  names = sorted((_NameHash(name), name, rowid) for name, rowid in (
+      (unicode(name).encode('utf8'), rowid) for rowid, name in
+      connection.execute("select rowid, entity_name from entities")))
+
+  tmp_loc = store_loc + ".tmp"
+  with open(tmp_loc, "wb") as ofile:
+    ofile.write("\0" * _STORE_HEADER.size)
+    record_offsets = [_STORE_HEADER.size]
+    for name_hash, name, rowid in names:
+      summary, content = connection.execute(
+          "select summary, content from entities where rowid=?", (rowid,)).fetchone()
+      texts = [None if t is None else zlib.compress(unicode(t).encode('utf8'))
+               for t in (summary, content)]
+      ofile.write(_RECORD_HEADER.pack(*[-1 if t is None else len(t) for t in texts]))
+      for t in texts:
+        if t is not None:
+          ofile.write(t)
+      record_offsets.append(ofile.tell())
+    record_offsets = numpy.array(record_offsets, dtype='<u8')
+
+    # Aligns the arrays, so that numpy doesn't copy them when they are searched.
+    ofile.write("\0" * (-ofile.tell() % 8))
+    record_offsets_start = ofile.tell()
+    ofile.write(record_offsets.tobytes())
+    hashes_start = ofile.tell()
+    ofile.write(numpy.array([h for h, name, rowid in names], dtype='<u8').tobytes())
+    name_offsets_start = ofile.tell()
+    name_offsets = numpy.zeros(len(names) + 1, dtype='<u8')
+    numpy.cumsum([len(name) for h, name, rowid in names], out=name_offsets[1:])
+    ofile.write(name_offsets.tobytes())
+    names_start = ofile.tell()
+    for h, name, rowid in names:
+      ofile.write(name)
+    ofile.seek(0)
+    ofile.write(_STORE_HEADER.pack(_STORE_MAGIC, len(names), record_offsets_start,
+                                   hashes_start, name_offsets_start, names_start))
+  os.rename(tmp_loc, store_loc)
+
+
 def LookupEntitySummary(entity_name):
   return EntityDB.GetTheDB().LookupEntitySummary(entity_name)
 
 def LookupEntityContent(entity_name):
   return EntityDB.GetTheDB().LookupEntityContent(entity_name)
+
+
+def ResetAfterFork():
+  """Initializer of multiprocessing.Pool workers.
+
+  Workers are forked once the parent has set the module state they read, such
+  as the data, feature matrices or model, so they share its pages. They must
+  not share its SQLite connection, nor send back the profiling stats it
+  recorded before the fork.
+  """
+  EntityDB.the_db = None
+  profiling.TakeSnapshot()
+
+
+def main():
+  utils.Initialize()
+  if not gflags.FLAGS.entity_store_loc:
+    print "Please specify --entity_store_loc"
+    sys.exit(1)
+  BuildEntityStore(gflags.FLAGS.baike_db_loc, gflags.FLAGS.entity_store_loc)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,196 @@
+"""Vectorized ranking metrics.
+
+The metrics of many queries are computed at once. The results of all queries
+are concatenated into flat arrays, and offsets gives the start of the results
+of each query, followed by the end of the last one:
+
+  offsets = [0, 3, 5]  # query 0 has results 0..2, query 1 results 3..4.
+
+AveragePrecision reproduces models.apk exactly, including its handling of
+duplicate results: only the first occurrence of a result in a ranking can be a
+hit, and every relevant label counts in the number of relevant results.
+
+Example:
+  order = RankOrder(offsets, scores, entity_keys)
+  hits, relevant = ApkHits(offsets, entity_keys[order], labels[order])
+  ap = AveragePrecision(offsets, hits, NumRelevant(offsets, labels))
+"""
+
+import numpy
+
+
+def SegmentIds(offsets):
+  """Query id of each result."""
+  offsets = numpy.asarray(offsets)
+  return numpy.repeat(numpy.arange(len(offsets) - 1), numpy.diff(offsets))
+
+
+def Positions(offsets):
+  """0-based position of each result in its query."""
+  offsets = numpy.asarray(offsets)
+  segments = SegmentIds(offsets)
+  return numpy.arange(offsets[-1]) - offsets[segments]
+
+
+def EntityKeys(entities):
+  """Integer keys of entity names, ordered like the names."""
+  if len(entities) == 0:
+    return numpy.zeros(0, dtype=numpy.int64)
+  return numpy.unique(numpy.array(entities), return_inverse=True)[1]
+
+
+def RankOrder(offsets, scores, keys):
+  """Permutation ranking the results of each query, same as models._RankByScores.
+
+  Results are sorted by descending score, then by descending key, then by
+  descending position.
+  """
+  segments = SegmentIds(offsets)
+  return numpy.lexsort((keys, scores, -segments))[::-1]
+
+
+def TopKOrder(scores, entities, k=None):
+  """Indices of the k best results of a single query, best first.
+
+  Results are ranked as models._RankByScores ranks them: by descending score,
+  then by descending entity, then by descending position. Only the results
+  scoring at least as high as the k-th best one are sorted, and entities are
+  only compared between results with equal scores.
+
+  Args:
+    k: number of results to keep, None for all of them.
+  """
+  scores = numpy.asarray(scores)
+  n = len(scores)
+  if k is not None and k <= 0:
+    return numpy.zeros(0, dtype=int)
+  if k is None or k >= n:
+    candidates = numpy.arange(n)
+  else:
+    threshold = numpy.partition(scores, n - k)[n - k]
+    candidates = numpy.flatnonzero(scores >= threshold)
+  # Stable, then reversed: equal scores are ranked by descending position.
+  order = candidates[numpy.argsort(scores[candidates], kind="mergesort")[::-1]]
+  ranked_scores = scores[order]
+  tied = numpy.flatnonzero(ranked_scores[1:] == ranked_scores[:-1])
+  if len(tied):
+    # Starts and ends of the runs of equal scores.
+    starts = tied[numpy.concatenate([[True], tied[1:] != tied[:-1] + 1])]
+    ends = tied[numpy.concatenate([tied[1:] != tied[:-1] + 1, [True]])] + 2
+    order = order.tolist()
+    for start, end in zip(starts, ends):
+      order[start:end] = sorted(order[start:end], key=lambda i: (entities[i], i),
+                                reverse=True)
+    order = numpy.array(order, dtype=int)
+  return order[:k]
+
+
+def NumRelevant(offsets, labels):
+  """Number of results labeled 1 in each query."""
+  return numpy.bincount(SegmentIds(offsets), weights=(numpy.asarray(labels) == 1),
+                        minlength=len(offsets) - 1).astype(numpy.int64)
+
+
+def ApkHits(offsets, ranked_keys, ranked_labels):
+  """Hits of ranked results, as models.apk counts them.
+
+  Returns:
+    (hits, relevant) boolean arrays. relevant is whether a result is labeled 1
+    anywhere in its query. hits is whether it is also its first occurrence in
+    the ranking.
+  """
+  n = len(ranked_keys)
+  if n == 0:
+    return numpy.zeros(0, dtype=bool), numpy.zeros(0, dtype=bool)
+  segments = SegmentIds(offsets)
+  # Groups equal results of a query together, in ranking order.
+  group_order = numpy.lexsort((numpy.arange(n), ranked_keys, segments))
+  sorted_segments = segments[group_order]
+  sorted_keys = numpy.asarray(ranked_keys)[group_order]
+  starts = numpy.ones(n, dtype=bool)
+  starts[1:] = ((sorted_segments[1:] != sorted_segments[:-1]) |
+                (sorted_keys[1:] != sorted_keys[:-1]))
+  group_ids = numpy.cumsum(starts) - 1
+  group_relevant = numpy.zeros(group_ids[-1] + 1, dtype=bool)
+  numpy.logical_or.at(group_relevant, group_ids,
+                      numpy.asarray(ranked_labels)[group_order] == 1)
+
+  relevant = numpy.empty(n, dtype=bool)
+  relevant[group_order] = group_relevant[group_ids]
+  first = numpy.empty(n, dtype=bool)
+  first[group_order] = starts
+  return relevant & first, relevant
+
+
+def _Cutoffs(offsets, k):
+  lengths = numpy.diff(numpy.asarray(offsets))
+  if k is None:
+    return lengths
+  return numpy.minimum(lengths, k)
+
+
+def AveragePrecision(offsets, hits, n_relevant, k=None):
+  """Average precision at k of each query, same as models.apk.
+
+  Args:
+    hits: boolean array, whether each ranked result is a hit (see ApkHits).
+    n_relevant: number of relevant results of each query.
+    k: cutoff, defaults to the number of results of each query.
+  """
+  cutoffs = _Cutoffs(offsets, k)
+  n_queries = len(cutoffs)
+  segments = SegmentIds(offsets)
+  positions = Positions(offsets)
+  hits = numpy.asarray(hits) & (positions < cutoffs[segments])
+  cum_hits = numpy.cumsum(hits)
+  cum_hits -= numpy.concatenate([[0], cum_hits])[numpy.asarray(offsets)[:-1]][segments]
+  # bincount sums in order, so the sums are the same floats as apk's.
+  precisions = numpy.where(hits, cum_hits / (positions + 1.0), 0.0)
+  sums = numpy.bincount(segments, weights=precisions, minlength=n_queries)
+  denominators = numpy.minimum(n_relevant, cutoffs)
+  ap = numpy.zeros(n_queries)
+  valid = denominators > 0
+  ap[valid] = sums[valid] / denominators[valid]
+  return ap
+
+
+def PrecisionAtK(offsets, hits, k):
+  """Fraction of the top k results of each query that are hits."""
+  segments = SegmentIds(offsets)
+  in_top_k = Positions(offsets) < k
+  return numpy.bincount(segments, weights=numpy.asarray(hits) & in_top_k,
+                        minlength=len(offsets) - 1) / float(k)
+
+
+def NDCG(offsets, ranked_labels, k=None):
+  """Normalized discounted cumulative gain at k of each query.
+
+  Gains are 2 ** label - 1, so that graded labels are supported. Queries
+  without any positive label have an NDCG of 0.
+  """
+  cutoffs = _Cutoffs(offsets, k)
+  n_queries = len(cutoffs)
+  segments = SegmentIds(offsets)
+  positions = Positions(offsets)
+  in_top_k = positions < cutoffs[segments]
+  labels = numpy.maximum(numpy.asarray(ranked_labels, dtype=float), 0)
+  discounts = numpy.where(in_top_k, 1 / numpy.log2(positions + 2.0), 0.0)
+
+  dcg = numpy.bincount(segments, weights=(2 ** labels - 1) * discounts,
+                       minlength=n_queries)
+  ideal_labels = labels[numpy.lexsort((-labels, segments))]
+  idcg = numpy.bincount(segments, weights=(2 ** ideal_labels - 1) * discounts,
+                        minlength=n_queries)
+  ndcg = numpy.zeros(n_queries)
+  valid = idcg > 0
+  ndcg[valid] = dcg[valid] / idcg[valid]
+  return ndcg
+
+
+def MeanAveragePrecision(offsets, scores, labels, keys, k=None):
+  """MAP of scored results, same as the mean of apk over the rankings."""
+  if len(offsets) <= 1:
+    return 0.0
+  order = RankOrder(offsets, scores, keys)
+  hits, _ = ApkHits(offsets, numpy.asarray(keys)[order], numpy.asarray(labels)[order])
+  return AveragePrecision(offsets, hits, NumRelevant(offsets, labels), k).mean()
@@ -11,13 +11,19 @@ import tqdm
 import json
 import random
 import gflags
-import copy
 import models
 import numpy
 import jinja2
 import sqlite3
+import itertools
+import multiprocessing
+import entitydb
+import profiling
 
 gflags.DEFINE_integer("cv_folds", 10, "folds of cross validations")
+gflags.DEFINE_integer("cv_workers", 1,
+                      "Number of processes training and evaluating cross "
+                      "validation folds in parallel.")
 gflags.DEFINE_string("experiment_db_loc", "experiments.db", "Experimental Result database")
 
 
@@ -50,6 +56,11 @@ class ExperimentDB(object):
       cv_result text,
       hd_result text
     )""")
+    columns = [row[1] for row in self.cursor.execute("pragma table_info(experiments)")]
+    # Added after the first experiments were recorded.
+    for column in ["profile", "params"]:
+      if column not in columns:
+        self.cursor.execute("alter table experiments add column %s text" % column)
     self.connection.commit()
 
   def CreateNewExperiemnt(self):
@@ -61,96 +72,154 @@ class ExperimentDB(object):
 
   def SaveResult(
           self, exp_id, e_name_list, celebrity_score, movie_score, 
-          restaurant_score, tvShow_score, cv_result, hd_result):
+          restaurant_score, tvShow_score, cv_result, hd_result, profile=None,
+          params=None):
+    """Records the results of an experiment.
+
+    Scores are None for experiments not evaluated on held-out data, such as
+    configurations a sweep stopped early.
+    """
+    scores = [celebrity_score, movie_score, restaurant_score, tvShow_score]
     self.cursor.execute(
         "update experiments set "
         "features=?, avg_map=?, celebrity=?, movie=?, restaurant=?, tvShow=?,"
-        "cv_result=?, hd_result=? where exp_id=? ", (
+        "cv_result=?, hd_result=?, profile=?, params=? where exp_id=? ", (
           e_name_list,
-          numpy.mean([celebrity_score, movie_score, restaurant_score, tvShow_score]),
+          None if None in scores else numpy.mean(scores),
           celebrity_score, movie_score, restaurant_score, tvShow_score,
-          json.dumps(cv_result), json.dumps(hd_result), exp_id,
+          json.dumps(cv_result), json.dumps(hd_result),
+          None if profile is None else json.dumps(profile),
+          None if params is None else json.dumps(params, sort_keys=True), exp_id,
         )
     )
     self.connection.commit()
 
 
-def _IterCVConfig(full_data, cv, seed=0):
+def IterCVSplits(full_data, cv, seed=0):
+  """Yields (train, test) selections, dicts from task name to query indices."""
   splitted = {}
   rdm = random.Random(seed)
   for task_name, data in full_data.iteritems():
     splitted[task_name] = []
-    shuffled_data = copy.copy(data)
-    rdm.shuffle(shuffled_data)
+    shuffled_ids = range(len(data))
+    rdm.shuffle(shuffled_ids)
     
     l = len(data)
     for i in range(cv):
       start = i * l / cv
       end = (i + 1) * l / cv
-      the_slice = shuffled_data[start:end]
+      the_slice = shuffled_ids[start:end]
       splitted[task_name].append(the_slice)
 
   for i in range(cv):
-    train_data = dict((t, []) for t in settings.sub_tasks)
+    train_ids = dict((t, []) for t in settings.sub_tasks)
     for j in range(cv):
       if j != i:
         for t in settings.sub_tasks:
-          train_data[t].extend(splitted[t][j])
-    test_data = dict((t, splitted[t][i]) for t in settings.sub_tasks)
-    yield (train_data, test_data)
+          train_ids[t].extend(splitted[t][j])
+    test_ids = dict((t, splitted[t][i]) for t in settings.sub_tasks)
+    yield (train_ids, test_ids)
+
+
+_cv_context = None
+
+
+def _RunCVFold((fold, (train_ids, test_ids))):
+  """Returns the result of a fold, and the profiling stats recorded for it."""
+  e_name_list, cv_data, features = _cv_context
+  seed = random.Random(fold)
+  if features is None:
+    train_data = dict((t, [cv_data[t][i] for i in ids]) for t, ids in train_ids.iteritems())
+    test_data = dict((t, [cv_data[t][i] for i in ids]) for t, ids in test_ids.iteritems())
+    model = models.BuildModel(e_name_list, train_data)
+    result = model.EvaluateOn(test_data, seed=seed)
+  else:
+    model = features.Subset(train_ids).TrainModel()
+    result = features.Subset(test_ids).Evaluate(model, seed=seed)
+  return result, profiling.TakeSnapshot() if profiling.Enabled() else None
+
+
+def CVReport(fold_results):
+  """Merges the results of cross validation folds, given in fold order."""
+  report_data = {}
+  for t in settings.sub_tasks:
+    scores = [result[t]["score"] for result in fold_results]
+    query_results = [r for result in fold_results for r in result[t]["query_results"]]
+    report_data[t] = {"score" : (numpy.mean(scores), numpy.std(scores)),
+                      "query_results" : query_results}
+  return report_data
 
 
 class Experiment(object):
 
-  def __init__(self, exp_id, timestamp, e_name_list, cv_result=None, hd_result=None):
+  def __init__(self, exp_id, timestamp, e_name_list, cv_result=None, hd_result=None,
+               params=None):
     self.exp_id = exp_id
     self.timestamp = timestamp
     self.e_name_list = e_name_list
     self.cv_result = cv_result
     self.hd_result = hd_result
+    self.profile = None
+    # LogisticRegression parameters, None for the defaults.
+    self.params = params
 
   def GetID(self):
     return self.exp_id
 
   def Save(self):
     exp_db = ExperimentDB.GetTheDB()
+    hd_result = self.hd_result or {}
     exp_db.SaveResult(
         self.exp_id, self.e_name_list,
-        self.hd_result["celebrity"]["score"],
-        self.hd_result["movie"]["score"],
-        self.hd_result["restaurant"]["score"],
-        self.hd_result["tvShow"]["score"],
+        hd_result.get("celebrity", {}).get("score"),
+        hd_result.get("movie", {}).get("score"),
+        hd_result.get("restaurant", {}).get("score"),
+        hd_result.get("tvShow", {}).get("score"),
         self.cv_result,
         self.hd_result,
+        self.profile,
+        self.params,
     )
 
-  def RunCrossValidation(self, cv_data, seed=0):
-    all_scores = dict((i, []) for i in settings.sub_tasks)
-    all_query_results = dict((i, []) for i in settings.sub_tasks)
-
-    for train_data, test_data in tqdm.tqdm(
-        _IterCVConfig(cv_data, gflags.FLAGS.cv_folds),
-        "Cross validating",
-        gflags.FLAGS.cv_folds):
-      model = models.BuildModel(self.e_name_list, train_data)
-      result = model.EvaluateOn(test_data)
-    
-      for t in settings.sub_tasks:
-        all_scores[t].append(result[t]["score"])
-        all_query_results[t].extend(result[t]["query_results"])
-
-    report_data = dict((i, {"score" : (None, None),}) for i in settings.sub_tasks)
-    for t in settings.sub_tasks:
-      scores = all_scores[t]
-      query_results = all_query_results[t]
-      report_data[t] = {"score" : (numpy.mean(scores), numpy.std(scores)),
-                      "query_results" : query_results}
-
-    self.cv_result = report_data
+  def RunCrossValidation(self, cv_data, seed=0, features=None):
+    """Runs cross validation on cv_data.
+
+    Folds run in --cv_workers processes. Results do not depend on the number of
+    workers: each fold has its own seed, and results are merged in fold order.
+
+    Args:
+      features: optional features.FeatureSet of cv_data. When given, folds are
+        trained and evaluated on its rows, instead of extracting features again.
+    """
+    global _cv_context
+    _cv_context = (self.e_name_list, cv_data, features)
+    folds = enumerate(IterCVSplits(cv_data, gflags.FLAGS.cv_folds, seed))
+    if gflags.FLAGS.cv_workers > 1:
+      pool = multiprocessing.Pool(gflags.FLAGS.cv_workers, entitydb.ResetAfterFork)
+      fold_results = pool.imap(_RunCVFold, folds)
+    else:
+      pool = None
+      fold_results = itertools.imap(_RunCVFold, folds)
+
+    results = []
+    for result, snapshot in tqdm.tqdm(fold_results, "Cross validating", gflags.FLAGS.cv_folds):
+      if snapshot is not None:
+        profiling.Merge(snapshot)
+      results.append(result)
+
+    if pool is not None:
+      pool.close()
+      pool.join()
+    _cv_context = None
+
+    self.cv_result = CVReport(results)
 
   def RecordHeldoutDataEval(self, hd_result):
     self.hd_result = hd_result
 
+  def RecordProfile(self, profile):
+    self.profile = profile
+
   def PrintSummary(self):
     print "Cross validation:"
     line = []
@@ -180,7 +249,7 @@ class Experiment(object):
       print >> ofile, template.render(report_data).encode('utf8')
 
 
-def StartNewExperiment(e_name_list):
+def StartNewExperiment(e_name_list, params=None):
   exp_db = ExperimentDB.GetTheDB()
   exp_id, timestamp = exp_db.CreateNewExperiemnt()
-  return Experiment(exp_id, timestamp, e_name_list)
+  return Experiment(exp_id, timestamp, e_name_list, params=params)
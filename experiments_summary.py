@@ -11,13 +11,14 @@ def main():
   cursor = connection.cursor()
   latest_results = list(
       cursor.execute(
-        "select E.exp_id, E.features, E.avg_map, "
+        "select E.exp_id, E.features, E.params, E.avg_map, "
         "E.celebrity, E.movie, E.restaurant, E.tvShow, E.timestamp from experiments as E inner join "
-        "(select exp_id, max(timestamp) from experiments group by features) b "
+        "(select exp_id, max(timestamp) from experiments group by features, params) b "
         "on E.exp_id = b.exp_id order by E.avg_map desc"))
   print tabulate.tabulate(
       latest_results,
-      headers=["ID", "features", "MAP", "Celebrity", "Movie", "Restaurant", "tvShow", "time"])
+      headers=["ID", "features", "params", "MAP", "Celebrity", "Movie", "Restaurant",
+               "tvShow", "time"])
 
 
 if __name__ == "__main__":
@@ -1,11 +1,22 @@
 """Exporting results for submission
+
+Queries of all subtasks are read lazily, ranked in batches by a pool of
+--export_workers processes, and written in input order as results complete.
+
+When the compact version of the model (see compactmodel.py) exists, it is used
+instead: it loads without sklearn, and workers share its memory mapped pages.
 """
 
 #!/usr/bin/python
 
+import collections
+import compactmodel
 import gflags
+import itertools
+import multiprocessing
+import datacache
+import entitydb
 import utils
-import models
 import settings
 import tqdm
 from os import path
@@ -20,45 +31,125 @@ gflags.DEFINE_string("output_dir", "output",
 gflags.DEFINE_string("results_limits", "restaurant:70",
                      "Comma separated list, specifying how many results I should export. "
                      "Default to export all.")
-
-
-def LoadTestData():
-  data = {}
-  for task in settings.sub_tasks:
-    data_loc = gflags.FLAGS.test_data_loc_template.format(task)
-    data[task] = utils.LoadInData(data_loc, test_data=True)
-  return data
-
-
-def ExportResult(model, testdata, subtask, output_filename, result_limit=None):
-  with open(output_filename, 'w') as ofile:
-    for query, entries in tqdm.tqdm(testdata, "Exporting results for {}".format(subtask)):
-      my_result = model.RankByModelProb((subtask, query), [i for (i, t) in entries])
-      if result_limit:
-        my_result = my_result[:result_limit]
-      print >> ofile, '\t'.join([query] + my_result).encode('gbk')
+gflags.DEFINE_integer("export_workers", 1,
+                      "Number of processes ranking queries.")
+gflags.DEFINE_integer("export_batch_size", 16,
+                      "Number of queries ranked with a single model call.")
+
+
+def _IterBatches(items, batch_size):
+  items = iter(items)
+  while True:
+    batch = list(itertools.islice(items, batch_size))
+    if len(batch) == 0:
+      return
+    yield batch
+
+
+def _Interleave(iterators):
+  """Round-robin over iterators, so that all of them make progress."""
+  iterators = collections.deque(iterators)
+  while iterators:
+    it = iterators.popleft()
+    try:
+      yield next(it)
+    except StopIteration:
+      continue
+    iterators.append(it)
+
+
+def _BoundedImap(pool, func, tasks, max_pending):
+  """Like pool.imap, but only reads max_pending tasks ahead of the results."""
+  pending = collections.deque()
+  for task in tasks:
+    pending.append(pool.apply_async(func, (task,)))
+    if len(pending) >= max_pending:
+      yield pending.popleft().get()
+  while pending:
+    yield pending.popleft().get()
+
+
+def _IterExportTasks(subtask, data_loc, batch_size, result_limit):
+  for batch in _IterBatches(datacache.IterData(data_loc, test_data=True), batch_size):
+    yield (subtask, batch, result_limit)
+
+
+_export_model = None
+
+
+def _RankBatch((subtask, batch, result_limit)):
+  rankings = _export_model.RankTopK(
+      [((subtask, query), [i for (i, t) in entries]) for query, entries in batch],
+      result_limit or None)
+  lines = []
+  for (query, _), my_result in zip(batch, rankings):
+    lines.append('\t'.join([query] + my_result).encode('gbk'))
+  return (subtask, lines)
+
+
+def ExportResults(model, data_locs, output_filenames, result_limits):
+  """Ranks the queries of several subtasks at the same time.
+
+  Args:
+    data_locs: dict from subtask to its test data location.
+    output_filenames: dict from subtask to its output location.
+    result_limits: dict from subtask to how many results to export, or None.
+  """
+  global _export_model
+  _export_model = model
+  batch_size = gflags.FLAGS.export_batch_size
+  tasks = _Interleave(
+      _IterExportTasks(subtask, data_locs[subtask], batch_size,
+                       result_limits.get(subtask))
+      for subtask in sorted(data_locs))
+
+  n_workers = gflags.FLAGS.export_workers
+  if n_workers > 1:
+    pool = multiprocessing.Pool(n_workers, entitydb.ResetAfterFork)
+    results = _BoundedImap(pool, _RankBatch, tasks, 4 * n_workers)
+  else:
+    pool = None
+    results = itertools.imap(_RankBatch, tasks)
+
+  ofiles = dict((subtask, open(loc, 'w')) for subtask, loc in output_filenames.iteritems())
+  progress = tqdm.tqdm(desc="Exporting results", unit="queries")
+  for subtask, lines in results:
+    for line in lines:
+      print >> ofiles[subtask], line
+    progress.update(len(lines))
+  progress.close()
+  for ofile in ofiles.itervalues():
+    ofile.close()
+
+  if pool is not None:
+    pool.close()
+    pool.join()
+  _export_model = None
 
 
 def main():
   utils.Initialize()
 
   model_loc = "{}/{}.model".format("models", gflags.FLAGS.model_id)
-  if not path.isfile(model_loc):
+  if path.isfile(compactmodel.CompactLoc(model_loc)):
+    model = compactmodel.CompactModel(compactmodel.CompactLoc(model_loc))
+  elif path.isfile(model_loc):
+    # Imported only when needed, as importing sklearn is slow.
+    import models
+    model = models.LogisticModel.LoadFrom(model_loc)
+  else:
     raise ValueError("Cannot find model {}".format(model_loc))
 
-  model = models.LogisticModel.LoadFrom(model_loc)
-
-  testdata = LoadTestData()
-
   limits = dict(
       i.split(":") for i in gflags.FLAGS.results_limits.split(","))
   limits = dict((k, int(v)) for k, v in limits.iteritems())
 
   utils.mkdir_p(gflags.FLAGS.output_dir)
-  for subtask in settings.sub_tasks:
-    output_filename = path.join(gflags.FLAGS.output_dir, subtask + ".txt")
-    ExportResult(model, testdata[subtask], subtask, output_filename,
-                 result_limit=limits.get(subtask, None))
+  data_locs = dict((subtask, gflags.FLAGS.test_data_loc_template.format(subtask))
+                   for subtask in settings.sub_tasks)
+  output_filenames = dict((subtask, path.join(gflags.FLAGS.output_dir, subtask + ".txt"))
+                          for subtask in settings.sub_tasks)
+  ExportResults(model, data_locs, output_filenames, limits)
 
 if __name__ == "__main__":
   main()
@@ -2,10 +2,29 @@
 
 When defining a new query, use @Extractor to register it into the extractor
 database.
+
+Extractors registered with @QueryExtractor take a QueryContext instead of the
+(q_type, query) pair. It holds the query-side work every candidate of a query
+shares: character sets, n-grams and feature names are computed once per query.
+
+Extractors can also be run over a batch of pairs, with ExtractBatch. Feature
+values are then written into a FeatureMatrixBuilder instead of being returned as
+(name, value) lists. Extractors registered with @BatchExtractor do so directly;
+the other ones are wrapped, and called on each pair, with one QueryContext for
+all the pairs of a query.
+
+Overlaps with entity summaries and contents use the n-gram index of ngramindex
+when --ngram_index_dir is set, instead of scanning the text.
 """
 import entitydb
+import ngramindex
+import numpy
+import profiling
+import timeit
 
 _extractors_map = {}
+_query_extractors_map = {}
+_batch_extractors_map = {}
 
 def Extractor(name):
   def wrappee(func):
@@ -13,49 +32,172 @@ def Extractor(name):
     return func
   return wrappee
 
-@Extractor("nchar")
-def ExtractNCharOverlapFeature((q_type, query), entity):
-  return [(q_type + 'NCharOverlap', len(set(query).intersection(set(entity))))]
 
+def QueryExtractor(name):
+  """Registers an extractor called as func(context, entity), see QueryContext."""
+  def wrappee(func):
+    _query_extractors_map[name] = func
+    return func
+  return wrappee
+
+
+class QueryContext(object):
+  """Query-side data shared by the extraction of all candidates of a query.
 
-@Extractor("char")
-def ExtractCharOverlapFeature((q_type, query), entity):
-  return [(q_type + 'CharOverlap=%s' % i, 1) for i in set(query).intersection(set(entity))]
+  Attributes:
+    q_type: subtask of the query.
+    query: the query text.
+    chars: set of the characters of the query.
+  """
+
+  def __init__(self, q_type, query):
+    self.q_type = q_type
+    self.query = query
+    self.chars = set(query)
+    self._ngrams = {}
+    self._packed_ngrams = {}
+    self._names = {}
+    self._packed_chars = None
+
+  def NGrams(self, n):
+    """Set of the n-grams of the query."""
+    if n not in self._ngrams:
+      self._ngrams[n] = set(EnumerateNGram(self.query, n))
+    return self._ngrams[n]
+
+  def PackedNGrams(self, n):
+    """Distinct n-grams of the query, packed as ngramindex.PackNGrams does."""
+    if n not in self._packed_ngrams:
+      self._packed_ngrams[n] = ngramindex.PackNGrams(self.query, n)
+    return self._packed_ngrams[n]
+
+  def PackedChars(self):
+    """(list of the distinct characters, their packed uint64 array)."""
+    if self._packed_chars is None:
+      chars = list(self.chars)
+      self._packed_chars = (chars, numpy.array([ord(c) for c in chars], dtype=numpy.uint64))
+    return self._packed_chars
+
+  def Name(self, name, value=None):
+    """Feature name q_type + name, or q_type + name=value, built once."""
+    key = (name, value)
+    if key not in self._names:
+      if value is None:
+        self._names[key] = self.q_type + name
+      else:
+        self._names[key] = self.q_type + name + '=%s' % value
+    return self._names[key]
+
+
+_last_context = None
+
+
+def GetQueryContext(q_type, query):
+  """QueryContext of a query, reused while the same query is extracted."""
+  global _last_context
+  # Read once: another thread may replace the cached context meanwhile.
+  context = _last_context
+  if context is None or (context.q_type, context.query) != (q_type, query):
+    context = QueryContext(q_type, query)
+    _last_context = context
+  return context
+
+
+def _PairExtractor(func):
+  """((q_type, query), entity) extractor calling a query extractor."""
+  def pair_extractor((q_type, query), entity):
+    return func(GetQueryContext(q_type, query), entity)
+  return pair_extractor
+
+
+@QueryExtractor("nchar")
+def ExtractNCharOverlapFeature(context, entity):
+  return [(context.Name('NCharOverlap'), len(context.chars.intersection(entity)))]
+
+
+@QueryExtractor("char")
+def ExtractCharOverlapFeature(context, entity):
+  return [(context.Name('CharOverlap', i), 1) for i in context.chars.intersection(entity)]
+
+
+def _LookupField(entity, field):
+  if field == "summary":
+    return entitydb.LookupEntitySummary(entity)
+  return entitydb.LookupEntityContent(entity)
+
+
+def _OverlappingChars(context, entity, field):
+  """Characters of the query which are in an entity field.
+
+  Raises:
+    IndexError: when entity doesn't have an entry.
+  """
+  index = ngramindex.NGramIndex.GetTheIndex()
+  if index is not None:
+    chars, packed = context.PackedChars()
+    found = index.Contains(entity, field, 1, packed)
+    return set(c for c, f in zip(chars, found) if f)
+  return context.chars.intersection(_LookupField(entity, field))
+
+
+def _CountNGramOverlaps(context, entity, field, n):
+  """Number of distinct n-grams of the query which are in an entity field.
+
+  Raises:
+    IndexError: when entity doesn't have an entry.
+  """
+  index = ngramindex.NGramIndex.GetTheIndex()
+  if index is not None:
+    return int(index.Contains(entity, field, n, context.PackedNGrams(n)).sum())
+  content_charset = set(EnumerateNGram(_LookupField(entity, field), n))
+  return len(context.NGrams(n).intersection(content_charset))
+
+
+def _MayContain(context, entity, field):
+  """False when the query is certainly not a substring of the entity field.
+
+  Raises:
+    IndexError: when entity doesn't have an entry.
+  """
+  index = ngramindex.NGramIndex.GetTheIndex()
+  if index is None or len(context.query) == 0:
+    return True
+  n = min(len(context.query), ngramindex.MAX_N)
+  return _CountNGramOverlaps(context, entity, field, n) == len(context.PackedNGrams(n))
 
 
-@Extractor("nsumchar")
-def ExtractNSumCharOverlapFeature((q_type, query), entity):
+@QueryExtractor("nsumchar")
+def ExtractNSumCharOverlapFeature(context, entity):
   try:
-    summary = entitydb.LookupEntitySummary(entity)
-    return [(q_type + 'NSumCharOverlap', len(set(query).intersection(set(summary))))]
+    return [(context.Name('NSumCharOverlap'),
+             len(_OverlappingChars(context, entity, "summary")))]
   except IndexError:
-    return [(q_type + 'NO_SUMMARY', 1)]
+    return [(context.Name('NO_SUMMARY'), 1)]
 
 
-@Extractor("sumchar")
-def ExtractSumCharOverlapFeature((q_type, query), entity):
+@QueryExtractor("sumchar")
+def ExtractSumCharOverlapFeature(context, entity):
   try:
-    summary = entitydb.LookupEntitySummary(entity)
-    return [(q_type + 'SumCharOverlap=%s' % i, 1) for i in set(query).intersection(set(summary))]
+    return [(context.Name('SumCharOverlap', i), 1)
+            for i in _OverlappingChars(context, entity, "summary")]
   except IndexError:
-    return [(q_type + 'NO_SUMMARY', 1)]
+    return [(context.Name('NO_SUMMARY'), 1)]
 
 
-@Extractor("cont_match")
-def ExtractQueryInContent((q_type, query), entity):
+@QueryExtractor("cont_match")
+def ExtractQueryInContent(context, entity):
   result = []
   try:
-    content = entitydb.LookupEntityContent(entity)
-    if query in content:
-      result.append((q_type + "SHOWED_UP_IN_CONTENT", 1))
-    content_charset = set(content)
-    for char in set(query).intersection(content_charset):
-      result.append((q_type + "ContCharOverlap=%s" % char, 1))
+    if _MayContain(context, entity, "content") and (
+        context.query in entitydb.LookupEntityContent(entity)):
+      result.append((context.Name("SHOWED_UP_IN_CONTENT"), 1))
+    for char in _OverlappingChars(context, entity, "content"):
+      result.append((context.Name("ContCharOverlap", char), 1))
 
     return result
 
   except IndexError:
-    return [(q_type + 'NO_CONTENT', 1)]
+    return [(context.Name('NO_CONTENT'), 1)]
 
 
 def EnumerateNGram(s, n):
@@ -68,57 +210,302 @@ def EnumerateNGram(s, n):
 
 # Bigram features
 
-@Extractor("cont_bigram")
-def ExtractQueryInContentBigram((q_type, query), entity):
+@QueryExtractor("cont_bigram")
+def ExtractQueryInContentBigram(context, entity):
   result = []
   try:
-    content = entitydb.LookupEntityContent(entity)
-    content_charset = set(EnumerateNGram(content, 2))
-    overlaps = len(set(EnumerateNGram(query, 2)).intersection(content_charset))
-    result.append((q_type + "ContBigramOverlaps", overlaps))
+    overlaps = _CountNGramOverlaps(context, entity, "content", 2)
+    result.append((context.Name("ContBigramOverlaps"), overlaps))
 
     return result
 
   except IndexError:
-    return [(q_type + 'NO_CONTENT', 1)]
+    return [(context.Name('NO_CONTENT'), 1)]
 
 
-@Extractor("cont_trigram")
-def ExtractQueryInContentTrigram((q_type, query), entity):
+@QueryExtractor("cont_trigram")
+def ExtractQueryInContentTrigram(context, entity):
   result = []
   try:
-    content = entitydb.LookupEntityContent(entity)
-    content_charset = set(EnumerateNGram(content, 3))
-    overlaps = len(set(EnumerateNGram(query, 3)).intersection(content_charset))
-    result.append((q_type + "ContTrigramOverlaps", overlaps))
+    overlaps = _CountNGramOverlaps(context, entity, "content", 3)
+    result.append((context.Name("ContTrigramOverlaps"), overlaps))
 
     return result
 
   except IndexError:
-    return [(q_type + 'NO_CONTENT', 1)]
+    return [(context.Name('NO_CONTENT'), 1)]
 
 
-def Extract2gramOverlap(text_ent_name, text_extractor):
-  def wrappee((q_type, query), entity):
+def Extract2gramOverlap(text_ent_name, text_extractor, field=None):
+  """Counts query bigrams in the text of an entity.
+
+  Args:
+    text_extractor: function from entity to its text.
+    field: entity field returned by text_extractor, if it is indexed.
+  """
+  def wrappee(context, entity):
     result = []
     try:
-      content = text_extractor(entity)
-      content_charset = set(EnumerateNGram(content, 2))
-      overlaps = len(set(EnumerateNGram(query, 2)).intersection(content_charset))
-      result.append((q_type + text_ent_name + "BigramOverlaps", overlaps))
+      if field is not None:
+        overlaps = _CountNGramOverlaps(context, entity, field, 2)
+      else:
+        content_charset = set(EnumerateNGram(text_extractor(entity), 2))
+        overlaps = len(context.NGrams(2).intersection(content_charset))
+      result.append((context.Name(text_ent_name + "BigramOverlaps"), overlaps))
 
       return result
 
     except IndexError:
-      return [(q_type + 'NO_%s' % text_ent_name, 1)]
+      return [(context.Name('NO_%s' % text_ent_name), 1)]
+
+  return wrappee
 
+QueryExtractor("2gcont")(Extract2gramOverlap(
+  'CONTENT', lambda entity: entitydb.LookupEntityContent(entity), "content"))
+QueryExtractor("2gsum")(Extract2gramOverlap(
+  'SUMMARY', lambda entity: entitydb.LookupEntitySummary(entity), "summary"))
+QueryExtractor("2gsurf")(Extract2gramOverlap('ENTITY', lambda entity: entity))
+
+
+class FeatureMatrixBuilder(object):
+  """Sparse feature matrix of a batch of (query, entity) pairs.
+
+  Features are collected as (row, column, value) entries. When an entry is set
+  more than once, the last value wins, as in dict() over a list of features.
+  Values of 0 are kept until the matrix is built, as they override earlier ones.
+
+  Attributes:
+    n_rows: number of pairs in the batch.
+    names: feature name of each column, in order of first use.
+  """
+
+  def __init__(self, n_rows):
+    self.n_rows = n_rows
+    self.names = []
+    self.vocabulary = {}
+    self._rows = []
+    self._cols = []
+    self._values = []
+
+  def Column(self, name):
+    """Returns the column of a feature, adding it if it is new."""
+    col = self.vocabulary.get(name)
+    if col is None:
+      col = self.vocabulary[name] = len(self.names)
+      self.names.append(name)
+    return col
+
+  def NumEntries(self):
+    """Number of entries added so far, repeats included."""
+    return sum(len(rows) for rows in self._rows)
+
+  def AddEntries(self, rows, cols, values):
+    self._rows.append(numpy.asarray(rows, dtype=int))
+    self._cols.append(numpy.asarray(cols, dtype=int))
+    self._values.append(numpy.asarray(values, dtype=float))
+
+  def Entries(self):
+    """Returns (rows, cols, values), sorted by row then column, without repeats."""
+    if len(self._rows) == 0:
+      return (numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int), numpy.zeros(0))
+    rows = numpy.concatenate(self._rows)
+    cols = numpy.concatenate(self._cols)
+    values = numpy.concatenate(self._values)
+    order = numpy.lexsort((numpy.arange(len(rows)), cols, rows))
+    rows, cols, values = rows[order], cols[order], values[order]
+    last = numpy.ones(len(rows), dtype=bool)
+    last[:-1] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    return rows[last], cols[last], values[last]
+
+  def ToCSR(self, vocabulary=None):
+    """Builds the CSR matrix.
+
+    Args:
+      vocabulary: optional dict from feature name to column. When given,
+        features are mapped to these columns, unknown ones and zeros are
+        dropped, as DictVectorizer.transform does.
+    """
+    from scipy import sparse
+    rows, cols, values = self.Entries()
+    if vocabulary is None:
+      n_cols = len(self.names)
+    else:
+      n_cols = len(vocabulary)
+      col_map = numpy.array(
+          [vocabulary.get(name, -1) for name in self.names], dtype=int)
+      cols = col_map[cols]
+      keep = (cols >= 0) & (values != 0)
+      rows, cols, values = rows[keep], cols[keep], values[keep]
+    matrix = sparse.csr_matrix((values, (rows, cols)), shape=(self.n_rows, n_cols))
+    matrix.sort_indices()
+    return matrix
+
+
+def BatchExtractor(name):
+  """Registers a batch version of an extractor.
+
+  The function is called as func(q_types, queries, entities, builder), where
+  the i-th pair of the batch is ((q_types[i], queries[i]), entities[i]), and
+  writes its features for row i into the FeatureMatrixBuilder.
+  """
+  def wrappee(func):
+    _batch_extractors_map[name] = func
+    return func
   return wrappee
 
-Extractor("2gcont")(Extract2gramOverlap(
-  'CONTENT', lambda entity: entitydb.LookupEntityContent(entity)))
-Extractor("2gsum")(Extract2gramOverlap(
-  'SUMMARY', lambda entity: entitydb.LookupEntitySummary(entity)))
-Extractor("2gsurf")(Extract2gramOverlap('ENTITY', lambda entity: entity))
+
+def _WrapPairExtractor(func):
+  def batch_extractor(q_types, queries, entities, builder):
+    rows = []
+    cols = []
+    values = []
+    for row, (q_type, query, entity) in enumerate(zip(q_types, queries, entities)):
+      for name, value in func((q_type, query), entity):
+        rows.append(row)
+        cols.append(builder.Column(name))
+        values.append(value)
+    builder.AddEntries(rows, cols, values)
+  return batch_extractor
+
+
+def _WrapQueryExtractor(func):
+  def batch_extractor(q_types, queries, entities, builder):
+    rows = []
+    cols = []
+    values = []
+    for context, group_rows in _IterByQuery(q_types, queries):
+      for row in group_rows:
+        for name, value in func(context, entities[row]):
+          rows.append(row)
+          cols.append(builder.Column(name))
+          values.append(value)
+    builder.AddEntries(rows, cols, values)
+  return batch_extractor
+
+
+def _IterByQuery(q_types, queries):
+  """Yields (QueryContext, rows) for each distinct query of a batch."""
+  groups = {}
+  for row, key in enumerate(zip(q_types, queries)):
+    groups.setdefault(key, []).append(row)
+  for (q_type, query), rows in groups.iteritems():
+    yield QueryContext(q_type, query), rows
+
+
+@BatchExtractor("nchar")
+def BatchExtractNCharOverlapFeature(q_types, queries, entities, builder):
+  for context, rows in _IterByQuery(q_types, queries):
+    builder.AddEntries(
+        rows, [builder.Column(context.Name('NCharOverlap'))] * len(rows),
+        [len(context.chars.intersection(entities[row])) for row in rows])
+
+
+@BatchExtractor("char")
+def BatchExtractCharOverlapFeature(q_types, queries, entities, builder):
+  for context, group_rows in _IterByQuery(q_types, queries):
+    rows = []
+    cols = []
+    for row in group_rows:
+      # Columns are only added for the characters an entity has.
+      for c in context.chars.intersection(entities[row]):
+        rows.append(row)
+        cols.append(builder.Column(context.Name('CharOverlap', c)))
+    builder.AddEntries(rows, cols, numpy.ones(len(rows)))
+
+
+@BatchExtractor("2gsurf")
+def BatchExtractEntityBigramOverlap(q_types, queries, entities, builder):
+  for context, rows in _IterByQuery(q_types, queries):
+    query_bigrams = context.NGrams(2)
+    builder.AddEntries(
+        rows, [builder.Column(context.Name('ENTITYBigramOverlaps'))] * len(rows),
+        [len(query_bigrams.intersection(EnumerateNGram(entities[row], 2))) for row in rows])
+
+
+def _BatchCountOverlaps(overlap_name, missing_name, count_overlaps):
+  """Batch extractor of a count feature, or a missing feature on IndexError.
+
+  Args:
+    count_overlaps: function from (QueryContext, entity) to the count.
+  """
+  def batch_extractor(q_types, queries, entities, builder):
+    for context, group_rows in _IterByQuery(q_types, queries):
+      overlap_col = builder.Column(context.Name(overlap_name))
+      rows = []
+      cols = []
+      values = []
+      for row in group_rows:
+        try:
+          values.append(count_overlaps(context, entities[row]))
+          cols.append(overlap_col)
+        except IndexError:
+          values.append(1)
+          cols.append(builder.Column(context.Name(missing_name)))
+        rows.append(row)
+      builder.AddEntries(rows, cols, values)
+  return batch_extractor
+
+BatchExtractor("nsumchar")(_BatchCountOverlaps(
+  'NSumCharOverlap', 'NO_SUMMARY',
+  lambda context, entity: len(_OverlappingChars(context, entity, "summary"))))
+BatchExtractor("cont_bigram")(_BatchCountOverlaps(
+  'ContBigramOverlaps', 'NO_CONTENT',
+  lambda context, entity: _CountNGramOverlaps(context, entity, "content", 2)))
+BatchExtractor("cont_trigram")(_BatchCountOverlaps(
+  'ContTrigramOverlaps', 'NO_CONTENT',
+  lambda context, entity: _CountNGramOverlaps(context, entity, "content", 3)))
+BatchExtractor("2gcont")(_BatchCountOverlaps(
+  'CONTENTBigramOverlaps', 'NO_CONTENT',
+  lambda context, entity: _CountNGramOverlaps(context, entity, "content", 2)))
+BatchExtractor("2gsum")(_BatchCountOverlaps(
+  'SUMMARYBigramOverlaps', 'NO_SUMMARY',
+  lambda context, entity: _CountNGramOverlaps(context, entity, "summary", 2)))
+
+
+def GetBatchExtractor(name):
+  if name in _batch_extractors_map:
+    return _batch_extractors_map[name]
+  if name in _query_extractors_map:
+    return _WrapQueryExtractor(_query_extractors_map[name])
+  return _WrapPairExtractor(_extractors_map[name])
+
+
+def _ProfiledBatchExtractor(name):
+  """Same as GetBatchExtractor(name), recording its calls for profiling."""
+  if name in _query_extractors_map and name not in _batch_extractors_map:
+    # Wrapped extractors are timed on each pair.
+    return _WrapQueryExtractor(profiling.ProfileCalls(
+        "extractor", name, _query_extractors_map[name], count_features=True))
+  if name not in _batch_extractors_map:
+    return _WrapPairExtractor(profiling.ProfileCalls(
+        "extractor", name, _extractors_map[name], count_features=True))
+
+  batch_extractor = _batch_extractors_map[name]
+  def profiled(q_types, queries, entities, builder):
+    n_entries = builder.NumEntries()
+    start = timeit.default_timer()
+    batch_extractor(q_types, queries, entities, builder)
+    profiling.GetStat("extractor", name).Add(
+        timeit.default_timer() - start, items=len(entities),
+        features=builder.NumEntries() - n_entries)
+  return profiled
+
+
+def ExtractBatch(extractor_name, q_types, queries, entities):
+  """Runs comma separated extractors over a batch of pairs.
+
+  Returns:
+    a FeatureMatrixBuilder, with the same features as dict(BuildExtractor(
+    extractor_name)((q_type, query), entity)) for each pair.
+  """
+  builder = FeatureMatrixBuilder(len(entities))
+  for name in extractor_name.split(','):
+    if profiling.Enabled():
+      extractor = _ProfiledBatchExtractor(name)
+    else:
+      extractor = GetBatchExtractor(name)
+    extractor(q_types, queries, entities, builder)
+  return builder
 
 
 def CombinedModel(*models):
@@ -130,6 +517,17 @@ def CombinedModel(*models):
   return wrappee
 
 
+def GetExtractor(name):
+  """The ((q_type, query), entity) extractor registered as name."""
+  if name in _query_extractors_map:
+    return _PairExtractor(_query_extractors_map[name])
+  return _extractors_map[name]
+
+
 def BuildExtractor(extractor_name):
   name_list = extractor_name.split(',')
-  return CombinedModel(*[_extractors_map[name] for name in name_list])
+  if profiling.Enabled():
+    return CombinedModel(*[profiling.ProfileCalls(
+        "extractor", name, GetExtractor(name), count_features=True)
+        for name in name_list])
+  return CombinedModel(*[GetExtractor(name) for name in name_list])
@@ -0,0 +1,304 @@
+"""Precomputed feature matrices.
+
+Extracting features is the most expensive part of an experiment. A FeatureTable
+extracts the features of every (query, entity) pair in the datasets once. Models
+for the cross validation folds and the held-out evaluation are then trained and
+evaluated on row slices of the same sparse matrix.
+
+Features are extracted, and cached on disk under --feature_cache_dir, one
+extractor at a time. A cache entry is keyed by the extractor name, a hash of the
+extractor source, the baike DB file and the queries and entities of a subtask.
+Adding an extractor to a feature set therefore only runs the new extractor.
+Helper functions called by extractors are not part of the key: remove the cache
+directory after changing them.
+
+Example:
+  table = FeatureTable("nchar,char", cv_data, hd_data)
+  cv_features, hd_features = table.datasets
+  model = cv_features.TrainModel()
+  hd_result = hd_features.Evaluate(model)
+"""
+
+import copy
+import gflags
+import hashlib
+import inspect
+import json
+import numpy
+import os
+import shutil
+import tempfile
+import models
+import extractors
+import profiling
+import utils
+from os import path
+from scipy import sparse
+
+gflags.DEFINE_string("feature_cache_dir", "feature_cache",
+                     "Directory to cache extracted features. Empty to disable.")
+
+
+class FeatureTable(object):
+
+  def __init__(self, extractors_name, *datasets, **kw):
+    """
+    Args:
+      columns: optional dict from (extractor name, dataset index, subtask) to
+        FeatureColumns already loaded, as in the columns of another table.
+    """
+    self.extractors_name = extractors_name
+    extractor_names = extractors_name.split(',')
+    self.columns = dict(kw.pop("columns", None) or {})
+
+    blocks = []
+    Y = []
+    self.datasets = []
+    for i, data in enumerate(datasets):
+      query_rows = {}
+      for subtask, subtask_data in data.iteritems():
+        start = len(Y)
+        query_rows[subtask] = []
+        for query, entity_info_list in subtask_data:
+          query_rows[subtask].append((len(Y), len(Y) + len(entity_info_list)))
+          Y.extend(gs for ent, gs in entity_info_list)
+        for name in extractor_names:
+          key = (name, i, subtask)
+          if key not in self.columns:
+            self.columns[key] = LoadFeatureColumns(name, subtask, subtask_data)
+          blocks.append((start, self.columns[key]))
+      self.datasets.append(FeatureSet(self, data, query_rows))
+
+    self.X, self.vectorizer = _MergeColumns(blocks, len(Y))
+    self.Y = numpy.array([int(y) for y in Y])
+
+  def Select(self, extractors_name):
+    """Table of some of the extractors of this one, without loading them again.
+
+    The result is the same as FeatureTable(extractors_name, *datasets).
+    """
+    return FeatureTable(extractors_name, *[d.data for d in self.datasets],
+                        columns=self.columns)
+
+  def ProjectFor(self, model):
+    """Returns a matrix mapping columns of the table to those of model."""
+    if models.IsHashing(model.vectorizer):
+      return models.HashProjection(model.vectorizer, self.vectorizer.feature_names_)
+    vocabulary = self.vectorizer.vocabulary_
+    model_cols = []
+    table_cols = []
+    for i, name in enumerate(model.vectorizer.feature_names_):
+      if name in vocabulary:
+        model_cols.append(i)
+        table_cols.append(vocabulary[name])
+    return sparse.csr_matrix(
+        (numpy.ones(len(table_cols)), (table_cols, model_cols)),
+        shape=(self.X.shape[1], len(model.vectorizer.feature_names_)))
+
+
+class FeatureSet(object):
+  """Rows of a FeatureTable that belong to a dataset.
+
+  Attributes:
+    data: the dataset, a dict from subtask to list of (query, entity_info_list).
+    query_rows: dict from subtask to a (start, end) row range for each query.
+  """
+
+  def __init__(self, table, data, query_rows):
+    self.table = table
+    self.data = data
+    self.query_rows = query_rows
+
+  def Subset(self, selection):
+    """Selects queries by their indices, given as a dict from subtask to list."""
+    return FeatureSet(
+        self.table,
+        dict((t, [self.data[t][i] for i in ids]) for t, ids in selection.iteritems()),
+        dict((t, [self.query_rows[t][i] for i in ids]) for t, ids in selection.iteritems()))
+
+  def Rows(self, subtask=None):
+    subtasks = sorted(self.query_rows) if subtask is None else [subtask]
+    ranges = [numpy.arange(s, e, dtype=int)
+              for t in subtasks for s, e in self.query_rows[t]]
+    if len(ranges) == 0:
+      return numpy.zeros(0, dtype=int)
+    return numpy.concatenate(ranges)
+
+  def TrainModel(self, params=None):
+    """
+    Args:
+      params: optional LogisticRegression parameters, such as C or penalty.
+    """
+    rows = self.Rows()
+    X = self.table.X[rows]
+    # Columns that never show up in training would get a zero weight, so only
+    # the others are kept, as if the vectorizer was fit on this subset.
+    cols = numpy.unique(X.indices)
+    names = [self.table.vectorizer.feature_names_[i] for i in cols]
+    if gflags.FLAGS.vectorizer == "hash":
+      vectorizer = models.BuildFeatureHasher()
+      X = (X[:, cols] * models.HashProjection(vectorizer, names)).tocsr()
+      X.sort_indices()
+    else:
+      vectorizer = copy.deepcopy(self.table.vectorizer)
+      vectorizer.restrict(cols, indices=True)
+      X = X[:, cols]
+    return models.LogisticModel.FromFeatures(
+        self.table.extractors_name, X, self.table.Y[rows], vectorizer,
+        feature_names=names, params=params)
+
+  def Evaluate(self, model, seed=None):
+    """Same as model.EvaluateOn(self.data), without extracting features again.
+
+    Models other than LogisticModel, such as a CascadeModel, score their own
+    features, so they extract them as EvaluateOn does.
+    """
+    if not isinstance(model, models.LogisticModel):
+      return model.EvaluateOn(self.data, seed=seed)
+    projection = self.table.ProjectFor(model)
+    scores = {}
+    for subtask, query_rows in self.query_rows.iteritems():
+      probs = model.ScoreMatrix(self.table.X[self.Rows(subtask)] * projection)
+      offsets = numpy.cumsum([0] + [e - s for s, e in query_rows])
+      scores[subtask] = [probs[s:e] for s, e in zip(offsets[:-1], offsets[1:])]
+    return model.EvaluateOn(self.data, seed=seed, scores=scores)
+
+
+class FeatureColumns(object):
+  """Features of a single extractor over the pairs of a subtask.
+
+  Attributes:
+    matrix: CSR matrix, with a row for each (query, entity) pair. Values of
+      features set to 0 are kept, as they may override other extractors.
+    names: feature name of each column.
+  """
+
+  def __init__(self, matrix, names):
+    self.matrix = matrix
+    self.names = names
+
+  def Save(self, cache_loc):
+    tmp_loc = tempfile.mkdtemp(dir=path.dirname(cache_loc))
+    numpy.save(path.join(tmp_loc, "data.npy"), self.matrix.data)
+    numpy.save(path.join(tmp_loc, "indices.npy"), self.matrix.indices)
+    numpy.save(path.join(tmp_loc, "indptr.npy"), self.matrix.indptr)
+    with open(path.join(tmp_loc, "names.json"), "w") as ofile:
+      json.dump(self.names, ofile)
+    try:
+      os.rename(tmp_loc, cache_loc)
+    except OSError:
+      # Another process stored the same columns first.
+      shutil.rmtree(tmp_loc)
+
+  @staticmethod
+  def LoadFrom(cache_loc):
+    arrays = [numpy.load(path.join(cache_loc, name + ".npy"), mmap_mode="r")
+              for name in ["data", "indices", "indptr"]]
+    with open(path.join(cache_loc, "names.json")) as infile:
+      names = json.load(infile)
+    return FeatureColumns(
+        sparse.csr_matrix(tuple(arrays), shape=(len(arrays[2]) - 1, len(names))),
+        names)
+
+
+def ExtractFeatureColumns(extractor_name, subtask, subtask_data):
+  q_types = []
+  queries = []
+  entities = []
+  for query, entity_info_list in subtask_data:
+    for ent, _ in entity_info_list:
+      q_types.append(subtask)
+      queries.append(query)
+      entities.append(ent)
+  builder = extractors.ExtractBatch(extractor_name, q_types, queries, entities)
+  return FeatureColumns(builder.ToCSR(), builder.names)
+
+
+def LoadFeatureColumns(extractor_name, subtask, subtask_data):
+  """Loads features of an extractor from the cache, extracting them if missing."""
+  cache_dir = gflags.FLAGS.feature_cache_dir
+  if not cache_dir:
+    return ExtractFeatureColumns(extractor_name, subtask, subtask_data)
+
+  key = hashlib.sha1()
+  key.update(_SourceFingerprint(extractors.GetBatchExtractor(extractor_name)))
+  key.update(_DBFingerprint())
+  key.update(_DataFingerprint(subtask, subtask_data))
+  utils.mkdir_p(path.join(cache_dir, extractor_name))
+  cache_loc = path.join(cache_dir, extractor_name, key.hexdigest())
+  if path.isdir(cache_loc):
+    load = FeatureColumns.LoadFrom
+    if profiling.Enabled():
+      # Features loaded from the cache don't show up in the extractor stats.
+      load = profiling.ProfileCalls("feature_cache", extractor_name, load)
+    return load(cache_loc)
+
+  columns = ExtractFeatureColumns(extractor_name, subtask, subtask_data)
+  columns.Save(cache_loc)
+  return columns
+
+
+def _SourceFingerprint(func):
+  parts = [inspect.getsource(func)]
+  # Extractors built by factories, such as Extract2gramOverlap, differ only in
+  # the values they closed over.
+  for cell in func.func_closure or ():
+    value = cell.cell_contents
+    if inspect.isfunction(value):
+      parts.append(_SourceFingerprint(value))
+    else:
+      parts.append(repr(value))
+  return "\n".join(parts)
+
+
+def _DBFingerprint():
+  db_loc = gflags.FLAGS.entity_store_loc or gflags.FLAGS.baike_db_loc
+  if not path.isfile(db_loc):
+    return "no db"
+  stat = os.stat(db_loc)
+  return "%s:%d:%d" % (path.abspath(db_loc), stat.st_size, stat.st_mtime)
+
+
+def _DataFingerprint(subtask, subtask_data):
+  h = hashlib.sha1(subtask.encode('utf8'))
+  for query, entity_info_list in subtask_data:
+    h.update(u'\t'.join([query] + [ent for ent, _ in entity_info_list]).encode('utf8'))
+    h.update('\n')
+  return h.hexdigest()
+
+
+def _MergeColumns(blocks, n_rows):
+  """Stacks feature columns into a single matrix, with a sorted vocabulary.
+
+  Args:
+    blocks: list of (first row, FeatureColumns). When blocks set the same
+      feature of a row, the last one wins, as in dict() over the concatenated
+      feature lists of CombinedModel.
+  Returns:
+    (X, vectorizer), as DictVectorizer.fit_transform would have produced.
+  """
+  all_names = sorted(set(name for _, columns in blocks for name in columns.names))
+  vocabulary = dict((name, i) for i, name in enumerate(all_names))
+
+  rows = [numpy.zeros(0, dtype=int)]
+  cols = [numpy.zeros(0, dtype=int)]
+  values = [numpy.zeros(0)]
+  for start, columns in blocks:
+    coo = columns.matrix.tocoo()
+    col_map = numpy.array([vocabulary[name] for name in columns.names], dtype=int)
+    rows.append(coo.row + start)
+    cols.append(col_map[coo.col])
+    values.append(coo.data)
+  rows = numpy.concatenate(rows)
+  cols = numpy.concatenate(cols)
+  values = numpy.concatenate(values)
+
+  order = numpy.lexsort((numpy.arange(len(rows)), cols, rows))
+  rows, cols, values = rows[order], cols[order], values[order]
+  last = numpy.ones(len(rows), dtype=bool)
+  last[:-1] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+  X = sparse.csr_matrix(
+      (values[last], (rows[last], cols[last])), shape=(n_rows, len(all_names)))
+  X.eliminate_zeros()
+
+  return X, models.BuildDictVectorizer(all_names)
@@ -4,18 +4,34 @@ This module includes a logisitc regression model, which assigns a probability
 for whether a result matches a query in a subtask.
 """
 
-import copy
 import gflags
+import itertools
 import numpy
 import random
 import sklearn
+import evaluation
 import extractors
 from sklearn import feature_extraction
 from sklearn.externals import joblib
 from sklearn import linear_model
 from sklearn import cross_validation
+from sklearn.utils import murmurhash3_32
+from scipy import sparse
 
 gflags.DEFINE_string("models_dir", "models", "Directory to store models.")
+gflags.DEFINE_enum("vectorizer", "dict", ["dict", "hash"],
+                   "How feature names are mapped to columns. 'dict' keeps a "
+                   "vocabulary of the training features; 'hash' hashes names "
+                   "into --hash_width columns, without any state.")
+gflags.DEFINE_integer("hash_width", 2 ** 18,
+                      "Number of columns of the hashing vectorizer.")
+gflags.DEFINE_boolean("hash_signed", True,
+                      "Whether the hashing vectorizer flips the sign of half "
+                      "of the features, so that collisions cancel out on "
+                      "average.")
+
+# Number of queries ranked at once when evaluating.
+_EVAL_BATCH_SIZE = 1024
 
 
 def apk(actual, predicted, k=None):
@@ -38,35 +54,12 @@ def apk(actual, predicted, k=None):
   return score / min(len(actual), k)
 
 
-class LogisticModel(object):
-
-  def __init__(self, extractors_name, train_data):
-    self.extractors_name = extractors_name
-    self.extractor = extractors.BuildExtractor(extractors_name)
-    all_train_data = []
-    for q_type, loaded_in_data in train_data.iteritems():
-      all_train_data.extend([(q_type, i) for i in loaded_in_data])
-
-    ml_train_data = []
-    for q_type, (query, entity_info_list) in all_train_data:
-      for ent, gs in entity_info_list:
-        ml_train_data.append((dict(self.extractor((q_type, query), ent)), gs))
-
-    v = feature_extraction.DictVectorizer()
-    D = [d for d, y in ml_train_data]
-    Y = numpy.array([int(y) for d, y in ml_train_data])
-    X = v.fit_transform(D)
-    logistic_regression = linear_model.LogisticRegression()
-
-    self.logistic_model = logistic_regression.fit(X, Y)
-    self.vectorizer = v
-
-  def __getstate__(self):
-    return (self.extractors_name, self.logistic_model, self.vectorizer)
+class RankingModel(object):
+  """Ranking and evaluation of models scoring the candidates of queries.
 
-  def __setstate__(self, state):
-    self.extractors_name, self.logistic_model, self.vectorizer = state
-    self.extractor = extractors.BuildExtractor(self.extractors_name)
+  Subclasses implement ScoreQueries(queries), which returns the scores of the
+  candidates of each query.
+  """
 
   def Save(self, model_loc):
     joblib.dump(self, model_loc)
@@ -75,31 +68,66 @@ class LogisticModel(object):
   def LoadFrom(model_loc):
     return joblib.load(model_loc)
 
-  def EvaluateOn(self, test_data, seed=None):
+  def EvaluateOn(self, test_data, seed=None, scores=None):
+    """Evaluates the model on test_data.
+
+    Args:
+      scores: optional dict from subtask to list of score arrays, one for each
+        query in test_data. When given, features are not extracted again.
+    """
     if seed is None:
       seed = random.Random()
 
     result = {}
     for sub_task, subtask_data in test_data.iteritems():
-      result[sub_task] = self._EvaluateSubtaskData(sub_task, subtask_data, seed=seed)
+      result[sub_task] = self._EvaluateSubtaskData(
+          sub_task, subtask_data, seed=seed,
+          scores=None if scores is None else scores[sub_task])
     result["score"] = numpy.mean([i["score"] for i in result.itervalues()])
     
     return result
 
   
   def RankByModelProb(self, (subtask, q), results):
-    return [r for s, r in sorted([
-      (self.ScoreByModel((subtask, q), r), r) for r in results], reverse=True)]
+    return _RankByScores(results, self.ScoreCandidates((subtask, q), results))
+
+  def RankQueries(self, queries):
+    """Ranks the candidates of many queries with a single ScoreQueries call.
+
+    Args:
+      queries: list of ((subtask, query), candidates) tuples.
+    Returns:
+      list of rankings, one per query, same as calling RankByModelProb on each.
+    """
+    return [_RankByScores(results, scores) for (_, results), scores in zip(
+        queries, self.ScoreQueries(queries))]
 
+  def RankTopK(self, queries, k):
+    """Same as RankQueries, keeping only the k best results of each query.
+
+    Only the best results are sorted. Ties are broken as in RankQueries, by
+    descending entity, but entities are only compared when their scores are
+    equal.
+
+    Args:
+      queries: list of ((subtask, query), candidates) tuples.
+      k: number of results to keep for every query, or a list with the number
+        for each query. None keeps all results.
+    """
+    return _RankTopK(queries, self.ScoreQueries(queries), k)
 
   def ScoreByModel(self, (subtask, q), r):
-    d = [dict(self.extractor((subtask, q), r))]
-    x = self.vectorizer.transform(d)
-    result = self.logistic_model.predict_proba(x)
-    return result[0][1]
+    return self.ScoreCandidates((subtask, q), [r])[0]
+
+  def ScoreCandidates(self, (subtask, q), results):
+    return self.ScoreQueries([((subtask, q), results)])[0]
 
+  def _EvaluateSubtaskData(self, subtask, subtask_data, seed=None, scores=None):
+    """Evaluates the model on the queries of a subtask.
 
-  def _EvaluateSubtaskData(self, subtask, subtask_data, seed=None):
+    subtask_data may be a lazy iterator: queries are ranked _EVAL_BATCH_SIZE
+    at a time, and only their report items are kept.
+    """
     if seed is None:
       seed = random.Random()
 
@@ -107,22 +135,47 @@ class LogisticModel(object):
   
     report_data = {"query_results" : [], "score" : None}
   
-    for q_id, (query, gs_result) in enumerate(subtask_data):
-      shuffled_result = copy.copy(gs_result)
-      seed.shuffle(shuffled_result)
-      my_result = self.RankByModelProb(
-        (subtask, query), [i for (i, t) in shuffled_result])
-      gs_result = [i for i, t in gs_result if t == 1]
-    
-      report_item = {"term" : query, "ranked" : [], "id" : q_id}
-      for r in my_result:
-        report_item['ranked'].append(
-          {'is_gs' : (r in gs_result), 'entity' : r})
-      map_score = apk(gs_result, my_result, len(shuffled_result))
-      report_item['MAP'] = map_score
-      report_data["query_results"].append(report_item)
-    
-      score_results.append(map_score)
+    subtask_data = iter(subtask_data)
+    q_id = 0
+    while True:
+      batch = list(itertools.islice(subtask_data, _EVAL_BATCH_SIZE))
+      if len(batch) == 0:
+        break
+      shuffled_results = []
+      for query, gs_result in batch:
+        order = range(len(gs_result))
+        seed.shuffle(order)
+        shuffled_results.append(
+            ((subtask, query), [gs_result[i][0] for i in order], order))
+      if scores is None:
+        batch_scores = self.ScoreQueries([(q, r) for q, r, _ in shuffled_results])
+      else:
+        batch_scores = [scores[q_id + i][order]
+                        for i, (_, _, order) in enumerate(shuffled_results)]
+
+      offsets = numpy.cumsum([0] + [len(r) for _, r, _ in shuffled_results])
+      entities = [e for _, r, _ in shuffled_results for e in r]
+      labels = numpy.array([gs_result[i][1] == 1
+                            for (_, gs_result), (_, _, order) in zip(batch, shuffled_results)
+                            for i in order], dtype=numpy.int8)
+      keys = evaluation.EntityKeys(entities)
+      ranking = evaluation.RankOrder(
+          offsets, numpy.concatenate(batch_scores) if entities else numpy.zeros(0), keys)
+      hits, relevant = evaluation.ApkHits(offsets, keys[ranking], labels[ranking])
+      ap = evaluation.AveragePrecision(
+          offsets, hits, evaluation.NumRelevant(offsets, labels))
+
+      for i, (query, _) in enumerate(batch):
+        report_item = {"term" : query, "ranked" : [], "id" : q_id}
+        for j in range(offsets[i], offsets[i + 1]):
+          report_item['ranked'].append(
+            {'is_gs' : bool(relevant[j]), 'entity' : entities[ranking[j]]})
+        map_score = float(ap[i])
+        report_item['MAP'] = map_score
+        report_data["query_results"].append(report_item)
+      
+        score_results.append(map_score)
+        q_id += 1
   
     map_value = sum(score_results) / len(score_results)
   
@@ -132,6 +185,294 @@ class LogisticModel(object):
     return report_data
 
 
+class LogisticModel(RankingModel):
+
+  def __init__(self, extractors_name, train_data):
+    self.extractors_name = extractors_name
+    self.extractor = extractors.BuildExtractor(extractors_name)
+    builder, Y = _ExtractTrainData(extractors_name, train_data)
+    names = _NonzeroNames(builder)
+    if gflags.FLAGS.vectorizer == "hash":
+      v = BuildFeatureHasher()
+    else:
+      v = BuildDictVectorizer(names)
+    self._Fit(VectorizeBatch(v, builder), Y, v, names)
+
+  @staticmethod
+  def FromFeatures(extractors_name, X, Y, vectorizer, feature_names=None, params=None):
+    """Trains a model on already extracted features.
+
+    Args:
+      X: feature matrix, vectorized by vectorizer.
+      Y: labels of the rows of X.
+      feature_names: names of the features in X, to count hash collisions.
+      params: optional LogisticRegression parameters, such as C or penalty.
+    """
+    model = LogisticModel.__new__(LogisticModel)
+    model.extractors_name = extractors_name
+    model.extractor = extractors.BuildExtractor(extractors_name)
+    model._Fit(X, Y, vectorizer, feature_names, params)
+    return model
+
+  def _Fit(self, X, Y, vectorizer, feature_names=None, params=None):
+    if feature_names is not None and IsHashing(vectorizer):
+      self.hash_collisions = CountHashCollisions(vectorizer, feature_names)
+    else:
+      self.hash_collisions = None
+    # liblinear shuffles samples; a fixed seed makes the fit independent of
+    # the global numpy random state, e.g. in cross validation workers.
+    logistic_regression = linear_model.LogisticRegression(random_state=0, **(params or {}))
+
+    self.logistic_model = logistic_regression.fit(X, Y)
+    self.vectorizer = vectorizer
+    # Kept, so that the model can be updated without extracting them again.
+    self.X = X
+    self.Y = Y
+
+  def Update(self, train_data, warm_start=True):
+    """Retrains the model with additional labeled queries.
+
+    Only the features of train_data are extracted. They are appended to the
+    training matrix kept in the model, and the vocabulary is extended with the
+    features it didn't have.
+
+    Args:
+      train_data: dict from subtask to list of (query, entity_info_list).
+      warm_start: when set, the solver starts from the current coefficients,
+        and converges in a few iterations. As liblinear can't warm start, this
+        uses lbfgs, or saga for l1, which don't regularize the intercept: the
+        result differs slightly from a fit from scratch. Otherwise, the model
+        is fit from scratch on all the training data, with liblinear.
+    Raises:
+      ValueError: if the model was saved without its training matrix.
+    """
+    if self.X is None:
+      raise ValueError("The model has no training matrix to update; it was "
+                       "saved by an older version, train it again.")
+    builder, Y = _ExtractTrainData(self.extractors_name, train_data)
+    X = self.X
+    coef = self.logistic_model.coef_
+    vectorizer = self.vectorizer
+    if not IsHashing(vectorizer):
+      names = sorted(set(vectorizer.feature_names_).union(builder.names))
+      if len(names) > len(vectorizer.feature_names_):
+        vectorizer = BuildDictVectorizer(names)
+        columns = numpy.array([vectorizer.vocabulary_[name]
+                               for name in self.vectorizer.feature_names_], dtype=int)
+        X = _ReindexColumns(X, columns, len(names))
+        expanded = numpy.zeros((coef.shape[0], len(names)))
+        expanded[:, columns] = coef
+        coef = expanded
+    X = sparse.vstack([X, VectorizeBatch(vectorizer, builder)], format="csr")
+    Y = numpy.concatenate([self.Y, Y])
+
+    previous = self.logistic_model
+    if not warm_start:
+      self._Fit(X, Y, vectorizer, params={"C" : previous.C, "penalty" : previous.penalty,
+                                          "class_weight" : previous.class_weight})
+      return
+    # liblinear can't warm start. lbfgs and saga don't penalize the intercept
+    # as liblinear does, so they minimize a slightly different objective.
+    logistic_regression = linear_model.LogisticRegression(
+        C=previous.C, penalty=previous.penalty, class_weight=previous.class_weight,
+        solver="lbfgs" if previous.penalty == "l2" else "saga",
+        warm_start=True, random_state=0)
+    logistic_regression.coef_ = coef
+    logistic_regression.intercept_ = previous.intercept_.copy()
+    self.logistic_model = logistic_regression.fit(X, Y)
+    self.vectorizer = vectorizer
+    self.X = X
+    self.Y = Y
+    # Names of the features of the previous rows aren't kept.
+    self.hash_collisions = None
+
+  def __getstate__(self):
+    return (self.extractors_name, self.logistic_model, self.vectorizer, self.X, self.Y)
+
+  def __setstate__(self, state):
+    if len(state) == 3:
+      # Saved before models kept their training matrix.
+      state = state + (None, None)
+    self.extractors_name, self.logistic_model, self.vectorizer, self.X, self.Y = state
+    self.hash_collisions = None
+    self.extractor = extractors.BuildExtractor(self.extractors_name)
+
+  def ScoreQueries(self, queries):
+    """Scores every candidate of every query in one sparse matrix.
+
+    Returns:
+      list of numpy arrays with the match probabilities, one per query.
+    """
+    q_types = []
+    q_list = []
+    entities = []
+    offsets = [0]
+    for (subtask, q), results in queries:
+      q_types.extend([subtask] * len(results))
+      q_list.extend([q] * len(results))
+      entities.extend(results)
+      offsets.append(len(entities))
+    builder = extractors.ExtractBatch(self.extractors_name, q_types, q_list, entities)
+    probs = self.ScoreMatrix(VectorizeBatch(self.vectorizer, builder))
+    return [probs[s:e] for s, e in zip(offsets[:-1], offsets[1:])]
+
+  def ScoreMatrix(self, x):
+    """Match probabilities of vectorized (query, entity) pairs."""
+    if x.shape[0] == 0:
+      return numpy.zeros(0)
+    return self.logistic_model.predict_proba(x)[:, 1]
+
+
+def _ExtractTrainData(extractors_name, train_data):
+  """Extracts the features of labeled data.
+
+  Returns:
+    (extractors.FeatureMatrixBuilder, numpy array of labels)
+  """
+  q_types = []
+  queries = []
+  entities = []
+  Y = []
+  for q_type, loaded_in_data in train_data.iteritems():
+    for query, entity_info_list in loaded_in_data:
+      for ent, gs in entity_info_list:
+        q_types.append(q_type)
+        queries.append(query)
+        entities.append(ent)
+        Y.append(int(gs))
+  builder = extractors.ExtractBatch(extractors_name, q_types, queries, entities)
+  return builder, numpy.array(Y)
+
+
+def _NonzeroNames(builder):
+  """Names of the features with a nonzero value in some row of builder.
+
+  Only these are columns of the training matrix, as in
+  features.FeatureSet.TrainModel, so both count the same hash collisions.
+  """
+  rows, cols, values = builder.Entries()
+  return [builder.names[i] for i in numpy.unique(cols[values != 0])]
+
+
+def _ReindexColumns(X, columns, n_columns):
+  """Moves column i of the CSR matrix X to columns[i], in a matrix of n_columns."""
+  X = sparse.csr_matrix((X.data, columns[X.indices], X.indptr),
+                        shape=(X.shape[0], n_columns))
+  X.sort_indices()
+  return X
+
+
+class CascadeModel(RankingModel):
+  """Two-stage model: a cheap model prunes the candidates of the full one.
+
+  The first stage scores every candidate with cheap features, such as those of
+  the entity name only. The shortlist_size best candidates of each query are
+  then scored by the full model, and ranked before the pruned candidates.
+  Expensive features, such as those of the entity content, are only extracted
+  for the shortlist.
+
+  Scores keep this order: shortlisted candidates score 2 + their probability
+  under the full model, pruned ones their probability under the first stage.
+
+  Unlike a LogisticModel, it cannot be updated or written as a compact model;
+  its two stages can.
+  """
+
+  def __init__(self, first_stage, model, shortlist_size):
+    self.first_stage = first_stage
+    self.model = model
+    self.shortlist_size = shortlist_size
+
+  def __getstate__(self):
+    return (self.first_stage, self.model, self.shortlist_size)
+
+  def __setstate__(self, state):
+    self.__init__(*state)
+
+  def ScoreQueries(self, queries):
+    first_scores = self.first_stage.ScoreQueries(queries)
+    shortlists = [evaluation.TopKOrder(scores, results, self.shortlist_size)
+                  for (_, results), scores in zip(queries, first_scores)]
+    full_scores = self.model.ScoreQueries(
+        [(q, [results[i] for i in shortlist])
+         for (q, results), shortlist in zip(queries, shortlists)])
+    cascade_scores = []
+    for scores, shortlist, shortlist_scores in zip(first_scores, shortlists, full_scores):
+      scores = numpy.array(scores, dtype=float)
+      scores[shortlist] = 2 + shortlist_scores
+      cascade_scores.append(scores)
+    return cascade_scores
+
+
+def BuildDictVectorizer(feature_names):
+  """A DictVectorizer, as if fit on dicts with the given feature names."""
+  v = feature_extraction.DictVectorizer()
+  v.feature_names_ = sorted(set(feature_names))
+  v.vocabulary_ = dict((name, i) for i, name in enumerate(v.feature_names_))
+  return v
+
+
+def BuildFeatureHasher():
+  return feature_extraction.FeatureHasher(
+      n_features=gflags.FLAGS.hash_width, alternate_sign=gflags.FLAGS.hash_signed)
+
+
+def IsHashing(vectorizer):
+  return isinstance(vectorizer, feature_extraction.FeatureHasher)
+
+
+def _HashFeature(hasher, name):
+  """Returns (column, sign) of a feature, as FeatureHasher.transform does."""
+  h = murmurhash3_32(name, seed=0)
+  sign = 1 if (h >= 0 or not hasher.alternate_sign) else -1
+  return abs(h) % hasher.n_features, sign
+
+
+def HashProjection(hasher, feature_names):
+  """Matrix mapping columns named feature_names to the hashed columns."""
+  cols = []
+  signs = []
+  for name in feature_names:
+    col, sign = _HashFeature(hasher, name)
+    cols.append(col)
+    signs.append(sign)
+  return sparse.csr_matrix(
+      (numpy.array(signs, dtype=float), (numpy.arange(len(cols)), cols)),
+      shape=(len(feature_names), hasher.n_features))
+
+
+def CountHashCollisions(hasher, feature_names):
+  """Number of features hashed into a column already used by another one."""
+  names = set(feature_names)
+  return len(names) - len(set(_HashFeature(hasher, name)[0] for name in names))
+
+
+def VectorizeBatch(vectorizer, builder):
+  """Feature matrix of an extractors.FeatureMatrixBuilder, for vectorizer."""
+  if IsHashing(vectorizer):
+    X = (builder.ToCSR() * HashProjection(vectorizer, builder.names)).tocsr()
+    X.sort_indices()
+    return X
+  return builder.ToCSR(vectorizer.vocabulary_)
+
+
+def _RankByScores(results, scores):
+  """Sorts results by descending score, breaking ties by descending result.
+
+  This is the order of sorted(zip(scores, results), reverse=True).
+  """
+  if len(results) == 0:
+    return []
+  order = numpy.lexsort((numpy.array(results), scores))[::-1]
+  return [results[i] for i in order]
+
+
+def _RankTopK(queries, scores, k):
+  if not isinstance(k, list):
+    k = [k] * len(queries)
+  return [[results[i] for i in evaluation.TopKOrder(query_scores, results, query_k)]
+          for (_, results), query_scores, query_k in zip(queries, scores, k)]
+
 
 def BuildModel(extractor, train_data):
   return LogisticModel(extractor, train_data)
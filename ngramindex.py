@@ -0,0 +1,145 @@
+"""Character n-gram index of the baike entity DB.
+
+Overlap extractors only need the set of character n-grams of an entity summary
+or content, but building it from a full Baike page on every call dominates
+their cost. This module computes the n-gram sets (n=1..3) of every entity once.
+
+Each n-gram is packed into an integer, 21 bits per character, so that the set of
+an entity is a sorted uint64 array. Arrays of all entities are concatenated into
+one file per (field, n), with an offset array, and are memory mapped when used.
+Looking up the n-grams of a query costs O(len(query) * log(len(text))).
+
+The index must be rebuilt when the DB changes:
+  python ngramindex.py --baike_db_loc=entities_db/baike.db \
+      --ngram_index_dir=entities_db/ngram_index
+"""
+
+import entitydb
+import gflags
+import json
+import numpy
+import sqlite3
+import sys
+import tqdm
+import utils
+from os import path
+
+gflags.DEFINE_string("ngram_index_dir", "",
+                     "Directory of the n-gram index built by ngramindex.py. "
+                     "When empty, extractors scan the entity text instead.")
+
+FIELDS = ["summary", "content"]
+MAX_N = 3
+
+_BITS_PER_CHAR = 21
+
+
+def PackNGramSequence(text, n):
+  """Returns all n-grams of text, in order, packed in a uint64 array."""
+  codes = numpy.frombuffer(text.encode('utf-32-le'), dtype='<u4').astype(numpy.uint64)
+  n_grams = len(codes) - n + 1
+  if n_grams <= 0:
+    return numpy.zeros(0, dtype=numpy.uint64)
+  keys = codes[:n_grams].copy()
+  for i in range(1, n):
+    keys |= codes[i:i + n_grams] << numpy.uint64(_BITS_PER_CHAR * i)
+  return keys
+
+
+def PackNGrams(text, n):
+  """Returns the distinct n-grams of text, packed and sorted in a uint64 array."""
+  return numpy.unique(PackNGramSequence(text, n))
+
+
+class NGramIndex(object):
+
+  the_index = None
+
+  def __init__(self, index_dir):
+    self.index_dir = index_dir
+    with open(path.join(index_dir, "names.json")) as infile:
+      names = json.load(infile)
+    self.entity_ids = dict((name, i) for i, name in enumerate(names))
+    self.keys = {}
+    self.offsets = {}
+    for field in FIELDS:
+      for n in range(1, MAX_N + 1):
+        prefix = path.join(index_dir, "%s.%d" % (field, n))
+        self.offsets[field, n] = numpy.load(prefix + ".offsets.npy")
+        if self.offsets[field, n][-1] == 0:
+          self.keys[field, n] = numpy.zeros(0, dtype=numpy.uint64)
+        else:
+          self.keys[field, n] = numpy.memmap(prefix + ".keys", dtype='<u8', mode='r')
+
+  @staticmethod
+  def GetTheIndex():
+    """Returns the index in --ngram_index_dir, or None if there is none."""
+    if NGramIndex.the_index is None and gflags.FLAGS.ngram_index_dir:
+      NGramIndex.the_index = NGramIndex(gflags.FLAGS.ngram_index_dir)
+    return NGramIndex.the_index
+
+  def NGrams(self, entity_name, field, n):
+    """Sorted packed n-grams of a field of the entity.
+
+    Raises:
+      IndexError: when entity doesn't have an entry.
+    """
+    try:
+      entity_id = self.entity_ids[entity_name]
+    except KeyError:
+      raise IndexError
+    offsets = self.offsets[field, n]
+    return self.keys[field, n][offsets[entity_id]:offsets[entity_id + 1]]
+
+  def Contains(self, entity_name, field, n, packed_ngrams):
+    """Boolean array, whether each of packed_ngrams is in the entity field."""
+    keys = self.NGrams(entity_name, field, n)
+    if len(keys) == 0:
+      return numpy.zeros(len(packed_ngrams), dtype=bool)
+    pos = numpy.searchsorted(keys, packed_ngrams)
+    pos[pos == len(keys)] = 0
+    return keys[pos] == packed_ngrams
+
+
+def BuildIndex(db_loc, index_dir):
+  utils.mkdir_p(index_dir)
+  connection = sqlite3.connect(db_loc)
+  (n_entities,) = connection.execute("select count(*) from entities").fetchone()
+
+  key_files = {}
+  offsets = {}
+  for field in FIELDS:
+    for n in range(1, MAX_N + 1):
+      key_files[field, n] = open(path.join(index_dir, "%s.%d.keys" % (field, n)), "wb")
+      offsets[field, n] = [0]
+
+  names = []
+  for row in tqdm.tqdm(
+      connection.execute("select entity_name, summary, content from entities"),
+      "Indexing n-grams", n_entities):
+    # entity_name has NUM affinity, numeric looking names are read as numbers.
+    names.append(unicode(row[0]))
+    for field, text in zip(FIELDS, row[1:]):
+      for n in range(1, MAX_N + 1):
+        keys = PackNGrams(text or u'', n).astype('<u8')
+        keys.tofile(key_files[field, n])
+        offsets[field, n].append(offsets[field, n][-1] + len(keys))
+
+  for field, n in key_files:
+    key_files[field, n].close()
+    numpy.save(path.join(index_dir, "%s.%d.offsets.npy" % (field, n)),
+               numpy.array(offsets[field, n], dtype=numpy.int64))
+  with open(path.join(index_dir, "names.json"), "w") as ofile:
+    json.dump(names, ofile)
+
+
+def main():
+  utils.Initialize()
+  if not gflags.FLAGS.ngram_index_dir:
+    print "Please specify --ngram_index_dir"
+    sys.exit(1)
+  BuildIndex(gflags.FLAGS.baike_db_loc, gflags.FLAGS.ngram_index_dir)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,145 @@
+"""Instrumentation of extractors and entity DB lookups.
+
+When --profile is set, extractors and EntityDB lookups are wrapped to record
+their number of calls, their latency and the number of features they emit.
+When it is not set, nothing is wrapped, so profiling costs nothing.
+
+Stats live in the process that recorded them. Worker processes send
+TakeSnapshot() to their parent, which merges it with Merge().
+
+Example:
+  python run_experiment.py --extractors=nchar,cont_match --profile
+"""
+
+import gflags
+import random
+import tabulate
+import timeit
+
+gflags.DEFINE_boolean("profile", False,
+                      "Record the latency of extractors and entity DB lookups.")
+
+# Number of latency samples kept per stat to estimate percentiles.
+_MAX_SAMPLES = 10000
+
+_stats = {}
+
+
+def Enabled():
+  return gflags.FLAGS.profile
+
+
+class Stat(object):
+  """Calls, latency and emitted features of an instrumented function.
+
+  Attributes:
+    calls: number of calls of the function.
+    items: number of items processed, (query, entity) pairs for extractors.
+    seconds: total time spent in the function.
+    features: number of features emitted.
+    samples: latencies per item of a uniform sample of the calls.
+  """
+
+  def __init__(self):
+    self.calls = 0
+    self.items = 0
+    self.seconds = 0.0
+    self.features = 0
+    self.samples = []
+    self.rdm = random.Random(0)
+
+  def Add(self, seconds, items=1, features=0):
+    self.calls += 1
+    self.items += items
+    self.seconds += seconds
+    self.features += features
+    latency = seconds / max(items, 1)
+    # Reservoir sampling, so samples stay a uniform sample of all calls.
+    if len(self.samples) < _MAX_SAMPLES:
+      self.samples.append(latency)
+    else:
+      i = self.rdm.randint(0, self.calls - 1)
+      if i < _MAX_SAMPLES:
+        self.samples[i] = latency
+
+  def Merge(self, other):
+    calls = self.calls + other.calls
+    samples = self.samples + other.samples
+    if len(samples) > _MAX_SAMPLES:
+      samples = self.rdm.sample(samples, _MAX_SAMPLES)
+    self.calls = calls
+    self.items += other.items
+    self.seconds += other.seconds
+    self.features += other.features
+    self.samples = samples
+
+  def Percentile(self, p):
+    if not self.samples:
+      return 0.0
+    samples = sorted(self.samples)
+    return samples[min(len(samples) - 1, int(p / 100.0 * len(samples)))]
+
+  def ToDict(self):
+    return {"calls" : self.calls,
+            "items" : self.items,
+            "seconds" : self.seconds,
+            "features" : self.features,
+            "p50_us" : self.Percentile(50) * 1e6,
+            "p99_us" : self.Percentile(99) * 1e6}
+
+
+def GetStat(category, name):
+  key = (category, name)
+  if key not in _stats:
+    _stats[key] = Stat()
+  return _stats[key]
+
+
+def ProfileCalls(category, name, func, count_features=False):
+  """Wraps func to record each of its calls.
+
+  Args:
+    count_features: when set, the length of the result of func is recorded as
+      the number of features it emits.
+  """
+  def profiled(*args, **kw):
+    start = timeit.default_timer()
+    result = func(*args, **kw)
+    # Looked up at each call, as TakeSnapshot replaces the stats.
+    GetStat(category, name).Add(timeit.default_timer() - start,
+                                features=len(result) if count_features else 0)
+    return result
+  return profiled
+
+
+def TakeSnapshot():
+  """Returns the stats recorded so far, and starts recording from scratch."""
+  global _stats
+  snapshot = _stats
+  _stats = {}
+  return snapshot
+
+
+def Merge(snapshot):
+  for (category, name), stat in snapshot.iteritems():
+    GetStat(category, name).Merge(stat)
+
+
+def Report():
+  """Dict from category to dict from name to the stats of each function."""
+  report = {}
+  for (category, name), stat in _stats.iteritems():
+    report.setdefault(category, {})[name] = stat.ToDict()
+  return report
+
+
+def PrintReport():
+  rows = []
+  for (category, name), stat in sorted(_stats.iteritems(),
+                                       key=lambda (key, stat): -stat.seconds):
+    s = stat.ToDict()
+    rows.append([category, name, s["calls"], s["items"], "%.3f" % s["seconds"],
+                 "%.1f" % s["p50_us"], "%.1f" % s["p99_us"], s["features"]])
+  print tabulate.tabulate(rows, headers=[
+      "category", "name", "calls", "items", "seconds", "p50 us/item",
+      "p99 us/item", "features"])
@@ -0,0 +1,262 @@
+"""A long running ranking service.
+
+The model and entity data are loaded once, and stay warm between requests.
+Requests are JSON over local HTTP (--port) or a Unix socket (--unix_socket):
+
+  POST /rank  {"subtask": "movie", "query": "...", "candidates": ["...", ...],
+               "limit": 10}
+    -> {"ranked": ["...", ...]}
+    "limit" is optional, and all candidates are ranked without it. Malformed
+    requests get a 400 reply, and never reach the ranking batch.
+  GET /stats
+    -> {"requests": ..., "p50_ms": ..., "p99_ms": ..., "batches": ...,
+        "pairs_per_batch": ...}
+
+Concurrent requests are micro-batched: a single thread collects the requests
+that arrive within --batch_wait_ms, extracts their features and ranks all of
+them with a single predict_proba call.
+
+Example:
+  python ranking_server.py --model_loc=models/101.model --port=8700
+"""
+
+import BaseHTTPServer
+import Queue
+import SocketServer
+import collections
+import gflags
+import json
+import numpy
+import os
+import settings
+import threading
+import time
+import compactmodel
+import utils
+
+gflags.DEFINE_string("model_loc", "models/101.model", "Model to serve.")
+gflags.DEFINE_integer("port", 8700, "Port to listen on, on localhost.")
+gflags.DEFINE_string("unix_socket", "",
+                     "When set, listen on this Unix socket instead of --port.")
+gflags.DEFINE_float("batch_wait_ms", 5,
+                    "How long to wait for more requests before ranking a batch.")
+gflags.DEFINE_integer("max_batch_pairs", 20000,
+                      "Maximum number of (query, candidate) pairs in a batch.")
+gflags.DEFINE_integer("latency_window", 10000,
+                      "Number of recent requests latency percentiles are over.")
+gflags.DEFINE_string("warm_up_data_loc_template", "",
+                     "Optional format template of test data of a subtask, "
+                     "ranked once at start-up to warm up the entity caches.")
+
+
+class _RankRequest(object):
+
+  def __init__(self, subtask, query, candidates, limit=None):
+    self.subtask = subtask
+    self.query = query
+    self.candidates = candidates
+    self.limit = limit
+    self.start_time = time.time()
+    self.done = threading.Event()
+    self.ranked = None
+    self.error = None
+
+
+class LatencyStats(object):
+  """Latency percentiles over the most recent requests."""
+
+  def __init__(self, window):
+    self.lock = threading.Lock()
+    self.latencies = collections.deque(maxlen=window)
+    self.n_requests = 0
+    self.n_batches = 0
+    self.n_pairs = 0
+
+  def RecordBatch(self, n_pairs):
+    with self.lock:
+      self.n_batches += 1
+      self.n_pairs += n_pairs
+
+  def RecordRequest(self, seconds):
+    with self.lock:
+      self.n_requests += 1
+      self.latencies.append(seconds)
+
+  def Summary(self):
+    with self.lock:
+      latencies = numpy.array(self.latencies) * 1000
+      summary = {"requests" : self.n_requests,
+                 "batches" : self.n_batches,
+                 "pairs_per_batch" : float(self.n_pairs) / max(self.n_batches, 1)}
+    if len(latencies):
+      summary["p50_ms"] = numpy.percentile(latencies, 50)
+      summary["p99_ms"] = numpy.percentile(latencies, 99)
+    return summary
+
+
+class Batcher(threading.Thread):
+  """Ranks queued requests in batches.
+
+  Feature extraction only happens in this thread, so the EntityDB connection
+  and caches are never shared between threads.
+  """
+
+  def __init__(self, model, stats):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.model = model
+    self.stats = stats
+    self.requests = Queue.Queue()
+
+  def Rank(self, subtask, query, candidates, limit=None):
+    """Ranks candidates; blocks until the batch of the request is ranked."""
+    request = _RankRequest(subtask, query, candidates, limit)
+    self.requests.put(request)
+    request.done.wait()
+    if request.error is not None:
+      raise request.error
+    return request.ranked
+
+  def _NextBatch(self):
+    batch = [self.requests.get()]
+    n_pairs = len(batch[0].candidates)
+    deadline = time.time() + gflags.FLAGS.batch_wait_ms / 1000.0
+    while n_pairs < gflags.FLAGS.max_batch_pairs:
+      timeout = deadline - time.time()
+      if timeout <= 0:
+        break
+      try:
+        request = self.requests.get(timeout=timeout)
+      except Queue.Empty:
+        break
+      batch.append(request)
+      n_pairs += len(request.candidates)
+    return batch, n_pairs
+
+  def run(self):
+    while True:
+      batch, n_pairs = self._NextBatch()
+      try:
+        rankings = self.model.RankTopK(
+            [((r.subtask, r.query), r.candidates) for r in batch],
+            [r.limit for r in batch])
+        for request, ranked in zip(batch, rankings):
+          request.ranked = ranked
+      except Exception, e:
+        for request in batch:
+          request.error = e
+      self.stats.RecordBatch(n_pairs)
+      for request in batch:
+        self.stats.RecordRequest(time.time() - request.start_time)
+        request.done.set()
+
+
+class RankingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  def _Reply(self, code, content):
+    body = json.dumps(content, ensure_ascii=False)
+    if isinstance(body, unicode):
+      body = body.encode('utf8')
+    self.send_response(code)
+    self.send_header("Content-Type", "application/json; charset=utf-8")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    # Requests are summarized by /stats; Unix socket clients have no address.
+    pass
+
+  def do_GET(self):
+    if self.path == "/stats":
+      self._Reply(200, self.server.stats.Summary())
+    else:
+      self._Reply(404, {"error" : "unknown path %s" % self.path})
+
+  def do_POST(self):
+    if self.path != "/rank":
+      self._Reply(404, {"error" : "unknown path %s" % self.path})
+      return
+    try:
+      length = int(self.headers.getheader("Content-Length", 0))
+      request = json.loads(self.rfile.read(length).decode('utf8'))
+      subtask = request["subtask"]
+      if subtask not in settings.sub_tasks:
+        raise ValueError("unknown subtask %s" % subtask)
+      query = request["query"]
+      if not isinstance(query, basestring):
+        raise ValueError("query must be a string")
+      candidates = request["candidates"]
+      if not isinstance(candidates, list) or not all(
+          isinstance(c, basestring) for c in candidates):
+        raise ValueError("candidates must be a list of strings")
+      limit = request.get("limit")
+      # bool is an int subclass, but not a valid limit.
+      if limit is not None and (not isinstance(limit, (int, long)) or
+                                isinstance(limit, bool) or limit < 0):
+        raise ValueError("limit must be a non-negative integer")
+    except (ValueError, KeyError, TypeError), e:
+      self._Reply(400, {"error" : "bad request: %s" % e})
+      return
+    try:
+      ranked = self.server.batcher.Rank(subtask, query, candidates, limit)
+    except Exception, e:
+      self._Reply(500, {"error" : "ranking failed: %s" % e})
+      return
+    self._Reply(200, {"ranked" : ranked})
+
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+
+class ThreadedUnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  daemon_threads = True
+
+
+def LoadModel(model_loc):
+  """Loads the compact version of a model when it exists, see compactmodel.py."""
+  if os.path.isfile(compactmodel.CompactLoc(model_loc)):
+    return compactmodel.CompactModel(compactmodel.CompactLoc(model_loc))
+  # Imported only when needed, as importing sklearn is slow.
+  import models
+  return models.LogisticModel.LoadFrom(model_loc)
+
+
+def WarmUp(batcher, data_loc, subtask):
+  """Ranks every query of a test data file once."""
+  for query, entries in utils.IterData(data_loc, test_data=True):
+    batcher.Rank(subtask, query, [i for i, t in entries])
+
+
+def main():
+  utils.Initialize()
+  model = LoadModel(gflags.FLAGS.model_loc)
+  stats = LatencyStats(gflags.FLAGS.latency_window)
+  batcher = Batcher(model, stats)
+  batcher.start()
+
+  if gflags.FLAGS.warm_up_data_loc_template:
+    for subtask in settings.sub_tasks:
+      data_loc = gflags.FLAGS.warm_up_data_loc_template.format(subtask)
+      if os.path.isfile(data_loc):
+        WarmUp(batcher, data_loc, subtask)
+
+  if gflags.FLAGS.unix_socket:
+    if os.path.exists(gflags.FLAGS.unix_socket):
+      os.remove(gflags.FLAGS.unix_socket)
+    server = ThreadedUnixHTTPServer(gflags.FLAGS.unix_socket, RankingHandler)
+    print "Serving on %s" % gflags.FLAGS.unix_socket
+  else:
+    server = ThreadedHTTPServer(("localhost", gflags.FLAGS.port), RankingHandler)
+    print "Serving on localhost:%d" % gflags.FLAGS.port
+  server.batcher = batcher
+  server.stats = stats
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    print "Latency: %s" % json.dumps(stats.Summary())
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,234 @@
+"""Candidate retrieval over the whole entity set.
+
+The models only rerank candidate lists. To serve open queries, this module keeps
+an inverted index from terms, the characters and character bigrams of entity
+names, summaries and contents, to the entities containing them. Entities are
+those listed in data/ENTITY SET, and their texts come from the baike DB.
+
+TopK scores entities by BM25 over the query terms, so that a LogisticModel only
+has to rerank a shortlist:
+  python retrieval.py --build_index
+  python retrieval.py --retrieve_query=... --retrieve_subtask=movie \
+      --rerank_model_id=101
+
+Index files, under --inverted_index_dir:
+  names.json: entity name of each document id.
+  subtasks.npy: bitmask of the subtasks (in settings.sub_tasks order) listing
+    each entity.
+  doc_lengths.npy: number of terms of each document.
+  terms.npy: sorted packed terms (see ngramindex.PackNGramSequence). A
+    character is packed as a unigram, so unigrams and bigrams do not collide.
+  offsets.npy: start of the posting list of each term.
+  postings, tfs: document ids (uint32) and term frequencies (uint16) of all
+    posting lists, memory mapped.
+"""
+
+import entitydb
+import gflags
+import io
+import json
+import math
+import numpy
+import models
+import ngramindex
+import settings
+import sys
+import tqdm
+import utils
+from os import path
+
+gflags.DEFINE_string("inverted_index_dir", "entities_db/inverted_index",
+                     "Directory of the inverted index for candidate retrieval.")
+gflags.DEFINE_string("entity_set_loc_template", "data/ENTITY SET/{}.ENTITYSET.txt",
+                     "Format template of the entity list of a subtask.")
+gflags.DEFINE_float("bm25_k1", 1.2, "BM25 term frequency saturation.")
+gflags.DEFINE_float("bm25_b", 0.75, "BM25 document length normalization.")
+gflags.DEFINE_boolean("build_index", False, "Build the inverted index.")
+gflags.DEFINE_string("retrieve_query", "", "Query to retrieve entities for.")
+gflags.DEFINE_string("retrieve_subtask", "", "Only retrieve entities of this subtask.")
+gflags.DEFINE_integer("retrieve_top_k", 100, "Number of entities to retrieve.")
+gflags.DEFINE_integer("rerank_model_id", 0,
+                      "When set, rerank retrieved entities with this model.")
+
+_CHUNK_SIZE = 2000
+
+
+def _TermCounts(text):
+  """Returns (terms, counts): the distinct packed characters and bigrams of text."""
+  terms = numpy.concatenate([ngramindex.PackNGramSequence(text, 1),
+                             ngramindex.PackNGramSequence(text, 2)])
+  return numpy.unique(terms, return_counts=True)
+
+
+class InvertedIndex(object):
+
+  the_index = None
+
+  def __init__(self, index_dir):
+    self.index_dir = index_dir
+    with open(path.join(index_dir, "names.json")) as infile:
+      self.names = json.load(infile)
+    self.subtasks = numpy.load(path.join(index_dir, "subtasks.npy"))
+    self.doc_lengths = numpy.load(path.join(index_dir, "doc_lengths.npy"))
+    self.terms = numpy.load(path.join(index_dir, "terms.npy"))
+    self.offsets = numpy.load(path.join(index_dir, "offsets.npy"))
+    if self.offsets[-1] == 0:
+      self.postings = numpy.zeros(0, dtype=numpy.uint32)
+      self.tfs = numpy.zeros(0, dtype=numpy.uint16)
+    else:
+      self.postings = numpy.memmap(path.join(index_dir, "postings"), dtype='<u4', mode='r')
+      self.tfs = numpy.memmap(path.join(index_dir, "tfs"), dtype='<u2', mode='r')
+    self.avg_doc_length = max(self.doc_lengths.mean(), 1.0) if len(self.doc_lengths) else 1.0
+
+  @staticmethod
+  def GetTheIndex():
+    if InvertedIndex.the_index is None:
+      InvertedIndex.the_index = InvertedIndex(gflags.FLAGS.inverted_index_dir)
+    return InvertedIndex.the_index
+
+  def Score(self, query):
+    """BM25 score of every document for query."""
+    k1 = gflags.FLAGS.bm25_k1
+    b = gflags.FLAGS.bm25_b
+    n_docs = len(self.names)
+    length_norm = k1 * (1 - b + b * self.doc_lengths / self.avg_doc_length)
+    scores = numpy.zeros(n_docs)
+    terms, query_tfs = _TermCounts(query)
+    term_ids = numpy.searchsorted(self.terms, terms)
+    for term, term_id, query_tf in zip(terms, term_ids, query_tfs):
+      if term_id == len(self.terms) or self.terms[term_id] != term:
+        continue
+      start, end = self.offsets[term_id], self.offsets[term_id + 1]
+      df = end - start
+      idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+      docs = self.postings[start:end]
+      tfs = self.tfs[start:end].astype(float)
+      # Posting lists hold each document once, so += on fancy indices is safe.
+      scores[docs] += query_tf * idf * tfs * (k1 + 1) / (tfs + length_norm[docs])
+    return scores
+
+  def TopK(self, query, k, subtask=None):
+    """Returns up to k (entity, score) with the highest BM25 score, best first.
+
+    Args:
+      subtask: when given, only entities of this subtask are retrieved.
+    """
+    scores = self.Score(query)
+    if subtask is not None:
+      mask = 1 << settings.sub_tasks.index(subtask)
+      scores[(self.subtasks & mask) == 0] = 0
+    candidates = numpy.flatnonzero(scores > 0)
+    if len(candidates) > k:
+      candidates = candidates[numpy.argpartition(-scores[candidates], k - 1)[:k]]
+    candidates = candidates[numpy.lexsort((candidates, -scores[candidates]))]
+    return [(self.names[i], scores[i]) for i in candidates]
+
+
+def Retrieve(model, subtask, query, k):
+  """Retrieves k entities for query, ranked by model."""
+  shortlist = InvertedIndex.GetTheIndex().TopK(query, k, subtask)
+  return model.RankByModelProb((subtask, query), [e for e, s in shortlist])
+
+
+def LoadEntitySet():
+  """Returns (entity names, subtask bitmask of each entity)."""
+  subtask_masks = {}
+  for i, subtask in enumerate(settings.sub_tasks):
+    with io.open(gflags.FLAGS.entity_set_loc_template.format(subtask),
+                 encoding='gbk') as infile:
+      for line in infile:
+        name = line.strip()
+        if name:
+          subtask_masks[name] = subtask_masks.get(name, 0) | (1 << i)
+  names = sorted(subtask_masks)
+  return names, numpy.array([subtask_masks[n] for n in names], dtype=numpy.uint8)
+
+
+def _DocumentText(name):
+  parts = [name]
+  try:
+    parts.append(entitydb.LookupEntitySummary(name) or u'')
+    parts.append(entitydb.LookupEntityContent(name) or u'')
+  except IndexError:
+    pass
+  return u'\n'.join(parts)
+
+
+def BuildIndex(index_dir):
+  """Builds the index in two passes over the entity texts.
+
+  The first pass counts the document frequency of every term, which gives the
+  offset of each posting list. The second one fills the memory mapped posting
+  lists, so their size is not bounded by memory.
+  """
+  utils.mkdir_p(index_dir)
+  names, subtasks = LoadEntitySet()
+
+  terms = numpy.zeros(0, dtype=numpy.uint64)
+  dfs = numpy.zeros(0, dtype=numpy.int64)
+  doc_lengths = numpy.zeros(len(names), dtype=numpy.uint32)
+  for chunk_start in tqdm.tqdm(range(0, len(names), _CHUNK_SIZE), "Counting terms"):
+    chunk_terms = [terms]
+    chunk_dfs = [dfs]
+    for doc_id in range(chunk_start, min(chunk_start + _CHUNK_SIZE, len(names))):
+      doc_terms, counts = _TermCounts(_DocumentText(names[doc_id]))
+      doc_lengths[doc_id] = counts.sum()
+      chunk_terms.append(doc_terms)
+      chunk_dfs.append(numpy.ones(len(doc_terms), dtype=numpy.int64))
+    terms, inverse = numpy.unique(numpy.concatenate(chunk_terms), return_inverse=True)
+    dfs = numpy.bincount(inverse, weights=numpy.concatenate(chunk_dfs)).astype(numpy.int64)
+
+  offsets = numpy.zeros(len(terms) + 1, dtype=numpy.int64)
+  numpy.cumsum(dfs, out=offsets[1:])
+  n_postings = int(offsets[-1])
+  if n_postings > 0:
+    postings = numpy.memmap(path.join(index_dir, "postings"), dtype='<u4',
+                            mode='w+', shape=(n_postings,))
+    tfs = numpy.memmap(path.join(index_dir, "tfs"), dtype='<u2',
+                       mode='w+', shape=(n_postings,))
+    next_pos = offsets[:-1].copy()
+    for doc_id, name in enumerate(tqdm.tqdm(names, "Filling posting lists")):
+      doc_terms, counts = _TermCounts(_DocumentText(name))
+      term_ids = numpy.searchsorted(terms, doc_terms)
+      pos = next_pos[term_ids]
+      postings[pos] = doc_id
+      tfs[pos] = numpy.minimum(counts, numpy.iinfo(numpy.uint16).max)
+      next_pos[term_ids] += 1
+    postings.flush()
+    tfs.flush()
+
+  with open(path.join(index_dir, "names.json"), "w") as ofile:
+    json.dump(names, ofile)
+  numpy.save(path.join(index_dir, "subtasks.npy"), subtasks)
+  numpy.save(path.join(index_dir, "doc_lengths.npy"), doc_lengths)
+  numpy.save(path.join(index_dir, "terms.npy"), terms)
+  numpy.save(path.join(index_dir, "offsets.npy"), offsets)
+
+
+def main():
+  utils.Initialize()
+  if gflags.FLAGS.build_index:
+    BuildIndex(gflags.FLAGS.inverted_index_dir)
+    return
+
+  if not gflags.FLAGS.retrieve_query:
+    print "Please specify --build_index or --retrieve_query"
+    sys.exit(1)
+  query = unicode(gflags.FLAGS.retrieve_query, 'utf8')
+  subtask = gflags.FLAGS.retrieve_subtask or None
+  if gflags.FLAGS.rerank_model_id:
+    if subtask is None:
+      print "Please specify --retrieve_subtask to rerank with a model"
+      sys.exit(1)
+    model = models.LogisticModel.LoadFrom(
+        "{}/{}.model".format("models", gflags.FLAGS.rerank_model_id))
+    for entity in Retrieve(model, subtask, query, gflags.FLAGS.retrieve_top_k):
+      print entity.encode('utf8')
+  else:
+    for entity, score in InvertedIndex.GetTheIndex().TopK(
+        query, gflags.FLAGS.retrieve_top_k, subtask):
+      print "%.4f\t%s" % (score, entity.encode('utf8'))
+
+
+if __name__ == "__main__":
+  main()
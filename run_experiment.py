@@ -15,6 +15,10 @@ import extractors
 import models
 import utils
 import experiments
+import features
+import datacache
+import profiling
+import compactmodel
 import unicodecsv as csv
 from os import path
 
@@ -22,6 +26,9 @@ from os import path
 gflags.DEFINE_string("extractors",
                      "nchar,char,nsumchar,sumchar,cont_bigram,cont_match",
                      "Extractors to use for experiemnt")
+gflags.DEFINE_boolean("precompute_features", True,
+                      "Extract features of the cross validation and held-out "
+                      "data once, and reuse them across folds.")
 gflags.DEFINE_string("reports_dir", "reports", "Directory to store reports.")
 gflags.DEFINE_string("report_template", "html/exp_report.html",
                      "Template for error analysis.")
@@ -36,14 +43,14 @@ def LoadCVData():
   data = {}
   for task in settings.sub_tasks:
     data_loc = gflags.FLAGS.cv_data_loc_template.format(task)
-    data[task] = utils.LoadInData(data_loc, test_data=False)
+    data[task] = datacache.LoadData(data_loc, test_data=False)
   return data
 
 def LoadHDData():
   data = {}
   for task in settings.sub_tasks:
     data_loc = gflags.FLAGS.hd_data_loc_template.format(task)
-    data[task] = utils.LoadInData(data_loc, test_data=False)
+    data[task] = datacache.LoadData(data_loc, test_data=False)
   return data
 
 
@@ -67,16 +74,38 @@ def main():
   cv_data = LoadCVData()
   hd_data = LoadHDData()
 
-  new_experiment.RunCrossValidation(cv_data)
-
-  model = models.BuildModel(e_name_list, cv_data)
-  model.Save(model_loc)
-  hd_result = model.EvaluateOn(hd_data)
+  if gflags.FLAGS.precompute_features:
+    table = features.FeatureTable(e_name_list, cv_data, hd_data)
+    cv_features, hd_features = table.datasets
+    new_experiment.RunCrossValidation(cv_data, features=cv_features)
+
+    model = cv_features.TrainModel()
+    model.Save(model_loc)
+    compactmodel.Write(model, compactmodel.CompactLoc(model_loc))
+    hd_result = hd_features.Evaluate(model)
+  else:
+    new_experiment.RunCrossValidation(cv_data)
+
+    model = models.BuildModel(e_name_list, cv_data)
+    model.Save(model_loc)
+    compactmodel.Write(model, compactmodel.CompactLoc(model_loc))
+    hd_result = model.EvaluateOn(hd_data)
   new_experiment.RecordHeldoutDataEval(hd_result)
 
+  if model.hash_collisions is not None:
+    print "Hash collisions: %d features share a column with another one.\n" % (
+        model.hash_collisions)
+
+  if profiling.Enabled():
+    new_experiment.RecordProfile(profiling.Report())
+
   new_experiment.Save()
   new_experiment.PrintSummary()
   new_experiment.ExportReport(report_loc)
+  if profiling.Enabled():
+    print
+    print "Profile:"
+    profiling.PrintReport()
 
   
 if __name__ == "__main__":
@@ -0,0 +1,139 @@
+"""Batched SQLite writer stage of the crawlers.
+
+Crawl results are put on a queue, and a single thread writes them with large
+executemany upserts (INSERT ... ON CONFLICT DO UPDATE). The DB is in WAL mode,
+and transactions are committed every --write_commit_interval seconds, so the
+scripts can read their progress while results are written.
+
+Upserts need a unique index on the key column of every table written to.
+"""
+
+import Queue
+import gflags
+import sqlite3
+import sys
+import threading
+import time
+from os import path
+
+# entitydb.py, which defines --baike_db_loc, is in the parent directory.
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), path.pardir))
+import entitydb
+
+gflags.DEFINE_integer("write_batch_size", 1000, "Number of rows written with one executemany.")
+gflags.DEFINE_float("write_commit_interval", 5, "Seconds between commits of the written rows.")
+
+# The table entitydb.py reads, see its documentation.
+ENTITIES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entities(
+  entity_name NUM,
+  title NUM,
+  link NUM,
+  summary TEXT,
+  content TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS entity_name on entities(entity_name);
+"""
+
+_TICK = object()
+
+
+def OpenDB(db_loc):
+  connection = sqlite3.connect(db_loc)
+  connection.execute("pragma journal_mode=WAL")
+  connection.execute("pragma synchronous=NORMAL")
+  return connection
+
+
+def UpsertStatement(table, key_column, columns):
+  """Inserts a row of columns, or updates them where key_column already exists."""
+  updates = ", ".join("%s=excluded.%s" % (c, c) for c in columns if c != key_column)
+  return "insert into %s(%s) values (%s) on conflict(%s) do update set %s" % (
+      table, ", ".join(columns), ", ".join("?" * len(columns)), key_column, updates)
+
+
+class BulkWriter(threading.Thread):
+  """Writes rows put on its queue to an SQLite DB.
+
+  Example:
+    writer = BulkWriter(db_loc, {"entities" : ("entity_name", ["entity_name", "content"])})
+    writer.start()
+    writer.Put("entities", (name, content))
+    writer.Close()
+  """
+
+  def __init__(self, db_loc, tables, batch_size=None, commit_interval=None):
+    """
+    Args:
+      tables: dict from table name to (key column, columns of the rows put).
+    """
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.db_loc = db_loc
+    self.statements = dict((table, UpsertStatement(table, key_column, columns))
+                           for table, (key_column, columns) in tables.iteritems())
+    self.batch_size = batch_size or gflags.FLAGS.write_batch_size
+    if commit_interval is None:
+      commit_interval = gflags.FLAGS.write_commit_interval
+    self.commit_interval = commit_interval
+    # Bounded, so that producers wait for a slow disk instead of filling memory.
+    self.queue = Queue.Queue(4 * self.batch_size)
+    self.error = None
+    self.n_written = 0
+
+  def Put(self, table, row):
+    if self.error is not None:
+      raise self.error
+    self.queue.put((table, row))
+
+  def Close(self):
+    """Writes all remaining rows and stops the thread."""
+    self.queue.put(None)
+    self.join()
+    if self.error is not None:
+      raise self.error
+
+  def _Write(self, connection, pending):
+    for table, rows in pending.iteritems():
+      if rows:
+        connection.executemany(self.statements[table], rows)
+        self.n_written += len(rows)
+        del rows[:]
+
+  def run(self):
+    connection = OpenDB(self.db_loc)
+    pending = dict((table, []) for table in self.statements)
+    n_pending = 0
+    last_commit = time.time()
+    try:
+      while True:
+        try:
+          item = self.queue.get(
+              timeout=max(0.01, last_commit + self.commit_interval - time.time()))
+        except Queue.Empty:
+          item = _TICK
+        if item is None:
+          break
+        if item is not _TICK:
+          table, row = item
+          pending[table].append(row)
+          n_pending += 1
+        if n_pending >= self.batch_size:
+          self._Write(connection, pending)
+          n_pending = 0
+        if time.time() - last_commit >= self.commit_interval:
+          self._Write(connection, pending)
+          n_pending = 0
+          connection.commit()
+          last_commit = time.time()
+      self._Write(connection, pending)
+      connection.commit()
+    except Exception, e:
+      self.error = e
+      # Unblocks producers waiting on a full queue.
+      while True:
+        item = self.queue.get()
+        if item is None:
+          break
+    finally:
+      connection.close()
@@ -0,0 +1,211 @@
+"""Shared crawling machinery of the scraping scripts.
+
+A small number of worker threads (--crawl_concurrency) send all requests.
+Each host has a pool of keep-alive connections and a token bucket limiting the
+request rate to it. Failed requests are retried with exponential backoff.
+
+Results are written to SQLite as they arrive (see bulk_writer.py), so an
+interrupted crawl resumes with the entries that are not fetched yet.
+
+--crawl_base_url replaces the scheme and host of every URL, to test a script
+against a local stand-in server:
+  python small_scripts/grab_entities.py --crawl_base_url=http://localhost:8000
+"""
+
+import Queue
+import gflags
+import httplib
+import logging
+import random
+import socket
+import threading
+import time
+import urlparse
+
+gflags.DEFINE_integer("crawl_concurrency", 16, "Number of requests in flight.")
+gflags.DEFINE_integer("crawl_connections_per_host", 8,
+                      "Maximum number of keep-alive connections to a host.")
+gflags.DEFINE_float("crawl_rate", 20, "Maximum number of requests per second to a host.")
+gflags.DEFINE_integer("crawl_max_retries", 5, "Number of retries of a failed request.")
+gflags.DEFINE_float("crawl_backoff_base", 0.5,
+                    "Seconds to wait before the first retry. Doubles at each retry.")
+gflags.DEFINE_float("crawl_backoff_max", 60, "Maximum seconds to wait before a retry.")
+gflags.DEFINE_float("crawl_timeout", 30, "Socket timeout of a request, in seconds.")
+gflags.DEFINE_string("crawl_base_url", "",
+                     "When set, replaces the scheme and host of every request.")
+
+_MAX_REDIRECTS = 5
+_USER_AGENT = "Mozilla/5.0 (compatible; baike-crawler)"
+
+
+class FetchError(Exception):
+  pass
+
+
+class _RetryableError(Exception):
+  pass
+
+
+class RateLimiter(object):
+  """Token bucket: allows rate requests per second, in bursts of up to burst."""
+
+  def __init__(self, rate, burst=1):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = burst
+    self.last_time = time.time()
+    self.lock = threading.Lock()
+
+  def Acquire(self):
+    """Blocks until a request is allowed."""
+    while True:
+      with self.lock:
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_time) * self.rate)
+        self.last_time = now
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return
+        wait = (1 - self.tokens) / self.rate
+      time.sleep(wait)
+
+
+class ConnectionPool(object):
+  """Keep-alive connections to a single host."""
+
+  def __init__(self, scheme, host, size, timeout):
+    self.connection_class = (
+        httplib.HTTPSConnection if scheme == "https" else httplib.HTTPConnection)
+    self.host = host
+    self.timeout = timeout
+    # None stands for a connection that is not opened yet.
+    self.connections = Queue.LifoQueue()
+    for i in range(size):
+      self.connections.put(None)
+
+  def Get(self, request_path):
+    """Returns (status, location header, body) of a GET request."""
+    connection = self.connections.get()
+    try:
+      if connection is None:
+        connection = self.connection_class(self.host, timeout=self.timeout)
+      connection.request("GET", request_path, headers={"User-Agent" : _USER_AGENT})
+      response = connection.getresponse()
+      body = response.read()
+      if response.will_close:
+        connection.close()
+        connection = None
+      return response.status, response.getheader("location"), body
+    except (socket.error, httplib.HTTPException), e:
+      if connection is not None:
+        connection.close()
+      connection = None
+      raise _RetryableError(str(e))
+    finally:
+      self.connections.put(connection)
+
+
+class HttpClient(object):
+  """Fetches URLs through per-host connection pools and rate limiters."""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.pools = {}
+    self.limiters = {}
+
+  def _HostState(self, scheme, host):
+    with self.lock:
+      if (scheme, host) not in self.pools:
+        self.pools[scheme, host] = ConnectionPool(
+            scheme, host, gflags.FLAGS.crawl_connections_per_host,
+            gflags.FLAGS.crawl_timeout)
+        self.limiters[scheme, host] = RateLimiter(gflags.FLAGS.crawl_rate)
+      return self.pools[scheme, host], self.limiters[scheme, host]
+
+  def _Get(self, url):
+    for i in range(_MAX_REDIRECTS + 1):
+      parsed = urlparse.urlsplit(url)
+      if gflags.FLAGS.crawl_base_url:
+        base = urlparse.urlsplit(gflags.FLAGS.crawl_base_url)
+        parsed = parsed._replace(scheme=base.scheme, netloc=base.netloc)
+      pool, limiter = self._HostState(parsed.scheme, parsed.netloc)
+      request_path = urlparse.urlunsplit(("", "", parsed.path or "/", parsed.query, ""))
+      limiter.Acquire()
+      status, location, body = pool.Get(request_path)
+      if status in (301, 302, 303, 307) and location:
+        url = urlparse.urljoin(urlparse.urlunsplit(parsed), location)
+        continue
+      if status == 429 or status >= 500:
+        raise _RetryableError("HTTP %d from %s" % (status, url))
+      if status >= 400:
+        raise FetchError("HTTP %d from %s" % (status, url))
+      return body
+    raise FetchError("Too many redirects from %s" % url)
+
+  def Fetch(self, url):
+    """Returns the body of url.
+
+    Raises:
+      FetchError: when the request still fails after --crawl_max_retries retries.
+    """
+    for attempt in range(gflags.FLAGS.crawl_max_retries + 1):
+      try:
+        return self._Get(url)
+      except _RetryableError, e:
+        logging.warning("Error retrieving %s, %s", url, e)
+        if attempt == gflags.FLAGS.crawl_max_retries:
+          break
+        wait = min(gflags.FLAGS.crawl_backoff_max,
+                   gflags.FLAGS.crawl_backoff_base * 2 ** attempt)
+        time.sleep(wait * random.uniform(0.5, 1))
+    raise FetchError("Gave up %s" % url)
+
+
+def Crawl(tasks, fetch_fn, concurrency=None):
+  """Runs fetch_fn on every task in worker threads.
+
+  Only a few tasks are queued ahead of the workers, so tasks can be a lazy
+  iterator of any length.
+
+  Args:
+    fetch_fn: function of a task, returning its result. It may raise FetchError.
+  Returns:
+    Generator of (task, result or error message, failed), in completion order.
+  """
+  concurrency = concurrency or gflags.FLAGS.crawl_concurrency
+  task_queue = Queue.Queue(2 * concurrency)
+  result_queue = Queue.Queue(2 * concurrency)
+  done = object()
+
+  def Feed():
+    for task in tasks:
+      task_queue.put(task)
+    for i in range(concurrency):
+      task_queue.put(done)
+
+  def Work():
+    while True:
+      task = task_queue.get()
+      if task is done:
+        result_queue.put(done)
+        return
+      try:
+        result_queue.put((task, fetch_fn(task), False))
+      except FetchError, e:
+        result_queue.put((task, str(e), True))
+      except Exception, e:
+        logging.exception("Error processing %r", task)
+        result_queue.put((task, str(e), True))
+
+  threads = [threading.Thread(target=Feed)] + [
+      threading.Thread(target=Work) for i in range(concurrency)]
+  for t in threads:
+    t.daemon = True
+    t.start()
+  n_running = concurrency
+  while n_running > 0:
+    result = result_queue.get()
+    if result is done:
+      n_running -= 1
+    else:
+      yield result
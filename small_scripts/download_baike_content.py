@@ -1,63 +1,56 @@
-import unicodecsv as csv
-import urllib
-import logging
-import threading
-import Queue
-import time
+"""
+Downloading the content of the Baike pages of the entities.
+
+Links come from the entities table of --baike_db_loc, filled by grab_entities.py,
+and contents are written back to it by bulk_writer.py as they arrive. Entities
+that have no content yet are fetched, so running the script again retries the
+pages that failed.
+  # python small_scripts/download_baike_content.py
+"""
+
+import gflags
+import sys
 from bs4 import BeautifulSoup
+import bulk_writer
+import crawler
 import tqdm
-baike_file = 'entities_db/baike.csv'
-
-link_data = dict((line['entity_name'], line['link'])for line in csv.DictReader(open(baike_file)) if line['link'])
-
-def FetchLink(link):
-  n_retry = 0
-  while n_retry <= 3:
-    try:
-      page = urllib.urlopen(link).read()
-      soup = BeautifulSoup(page)
-      text = "\n".join([i.text for i in soup('div', {'class' : 'para'})])
-      return text
-    except Exception, e:
-      logging.error("Error retrieving %s, %s", link, e)
-      n_retry += 1
-      time.sleep(3)
-  logging.error("Gave up %s", link)
-  return None
-
-task_queue = Queue.Queue()
-write_queue = Queue.Queue()
-
-class Worker(threading.Thread):
-  def run(self):
-    while True:
-      name, link = task_queue.get()
-      if link.startswith('/'):
-        link = "http://baike.baidu.com" + link
-      content = FetchLink(link)
-      write_queue.put((name, content))
-      
-class Writer(threading.Thread):
-  def __init__(self, outputfile, total_n):
-    threading.Thread.__init__(self)
-    self.outfile = open(outputfile, 'w')
-    self.writer = csv.DictWriter(self.outfile, ['entity_name', 'content'])
-    self.writer.writeheader()
-    self.total_n = total_n
-  
-  def run(self):
-    for i in tqdm.tqdm(range(self.total_n)):
-      name, content = write_queue.get()
-      self.writer.writerow({'entity_name' : name, 'content' : content})
-      self.outfile.flush()
-
-workers = [Worker() for i in range(100)]
-writer = Writer("entities_db/baike_content.csv", len(link_data))
-
-for w in workers + [writer]:
-  w.start()
-
-for ename, link in link_data.iteritems():
-  task_queue.put((ename, link))
-
-writer.join()
+
+
+def FetchLink(client, link):
+  if link.startswith('/'):
+    link = "http://baike.baidu.com" + link
+  page = client.Fetch(link)
+  soup = BeautifulSoup(page)
+  return "\n".join([i.text for i in soup('div', {'class' : 'para'})])
+
+
+def main(argv):
+  try:
+    argv = gflags.FLAGS(argv)  # parse flags
+  except gflags.FlagsError, e:
+    print '%s\\nUsage: %s ARGS\\n%s' % (e, sys.argv[0], gflags.FLAGS)
+    sys.exit(1)
+
+  conn = bulk_writer.OpenDB(gflags.FLAGS.baike_db_loc)
+  conn.executescript(bulk_writer.ENTITIES_SCHEMA)
+  link_data = dict(conn.execute(
+    "select entity_name, link from entities where link != '' and content is null"))
+  conn.close()
+
+  writer = bulk_writer.BulkWriter(gflags.FLAGS.baike_db_loc, {
+    "entities" : ("entity_name", ["entity_name", "content"])})
+  writer.start()
+  client = crawler.HttpClient()
+  n_failed = 0
+  for name, content, failed in tqdm.tqdm(
+      crawler.Crawl(sorted(link_data), lambda name: FetchLink(client, link_data[name])),
+      total=len(link_data)):
+    if failed:
+      n_failed += 1
+    else:
+      writer.Put("entities", (name, content))
+  writer.Close()
+  print "%d pages failed, run again to retry them" % n_failed
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -1,9 +1,13 @@
+# -*- coding: utf-8 -*-
 """
 Grabbing Baidu Baike for entity definitions.
 
-This script grabs all entities in the entity directory, and put them into --db_loc.
-It grabs everything in a multi-threading fashion. The first time some fetching attmpts may fail,
-so we need several runs to guarantee every entity has some data.
+This script grabs all entities in the entity directory. Search result pages are
+kept in --db_loc, and the title, link and summary of the first result of each
+entity are written to the entities table of --baike_db_loc, which entitydb.py
+reads. Requests are sent by crawler.py, and results are written by
+bulk_writer.py as they arrive, so an interrupted run continues with the entities
+that are not fetched yet.
 
 First time:
   # python grab_entities.py --retry_on_failed=false
@@ -11,24 +15,25 @@ First time:
 You may then see how many entries were not fetched by:
   # sqlite3 entities_db/entities.db 'select count(*) from search_results where failed'
 
-When the number is not 0, iteratively try for a couple of times:
+When the number is not 0, try again:
   # python grab_entities.py
+
+Then download the contents of the pages with download_baike_content.py.
 """
 
 import os
 from os import path
-import sqlite3
-import threading
-import Queue
 import urllib
 import sys
 from bs4 import BeautifulSoup
+import bulk_writer
+import crawler
 import gflags
 
-gflags.DEFINE_boolean("retry_on_failed", True, "When set, will only retry on failed entities.")
+gflags.DEFINE_boolean("retry_on_failed", True,
+                      "When set, will only fetch failed or missing entities.")
 gflags.DEFINE_string("db_loc", "entities_db/entities.db", 
-                     "When set, will only retry on failed entities.")
-gflags.DEFINE_integer("n_fetching_threads", 500, "Number of threads to retrieve results.")
+                     "SQLite DB the search result pages are written to.")
 gflags.DEFINE_string("entity_dir", "data/ENTITY SET", "Directory containing entities.")
 
 def GetAllEntities():
@@ -43,80 +48,49 @@ def GetAllEntities():
   return all_entities
 
 
-def SearchForEntityName(name):
+def SearchForEntityName(client, name):
   request_template = 'http://baike.baidu.com/search?%s'
-  #urllib.urlopen('')
   args = urllib.urlencode({"word" : name.encode('utf8'), 'pn' : 0, 'rn' : 0, 'enc' : 'utf8'})
   request = request_template % args
 
-  response = urllib.urlopen(request).read()
+  response = client.Fetch(request)
   return unicode(response, 'utf8', 'ignore')
 
-task_queue = Queue.Queue()
-writing_queue = Queue.Queue()
-
-class FetchingThread(threading.Thread):
-  def run(self):
-    while True:
-      name = task_queue.get()  
-      if name is None:
-        break
-      writing_queue.put(self.TryFetchingResult(name))
-
-  def TryFetchingResult(self, name):
-    try:
-      result = SearchForEntityName(name)
-      return (name, result, False)
-    except Exception, e:
-      return (name, str(e), True)
-
-class WritingThread(threading.Thread):
-  
-  def __init__(self, db_loc, len_all_entities, modify=False):
-    threading.Thread.__init__(self)
-    self.db_loc = db_loc
-    self.len_all_entities = len_all_entities
-    self.modify = modify
-
-  def run(self):
-    conn = sqlite3.connect(self.db_loc)
-    cursor = conn.cursor()
-    if not self.modify:
-      cursor.execute(
-        'create table search_results(entity_name text, response text, failed bool)')
-      cursor.execute('create index ent_name on search_results(entity_name);')
-      conn.commit()
-
-    def EntityNameAlreadyOccur(ename):
-      cursor.execute('select count(*) from search_results where entity_name=?' , (ename,))
-      (n_occur, ) = cursor.fetchone()
-      return (n_occur > 0)
-    
-    n_finished = 0
-    while n_finished < self.len_all_entities:
-      entity_name, text, failed = writing_queue.get()
-      
-      if not self.modify or not EntityNameAlreadyOccur(entity_name):
-        cursor.execute(
-          'insert into search_results values (?, ?, ?)', (entity_name, text, failed))
-      else:
-        cursor.execute(
-          'update search_results set response=?,failed=? where entity_name=?', (
-            text, failed, entity_name))
-      n_finished += 1
-      if n_finished % 100 == 0:
-        print "finished %d, out of %d" % (n_finished, self.len_all_entities)
-        conn.commit()
-    conn.commit()
-
-def GetFailedEntities(loc):
-  conn = sqlite3.connect(loc)
-  cursor = conn.cursor()
-  successful_entities = [i[0] for i in cursor.execute(
-    'select entity_name from search_results where not failed')]
-  failed_entities = set(GetAllEntities()) - set(successful_entities)
-  return failed_entities
-  
+
+def ExtractFirstDesc(response):
+  """Title, link and summary of the first search result.
+
+  Raises:
+    IndexError: when the page has no search result.
+  """
+  soup = BeautifulSoup(response)
+  result = soup.find_all('dd')[0]
+  title = result.find_all('a', {'class' : 'result-title'})[0]
+  summary = result.find_all('p', {'class' : 'result-summary'})[0]
+  return {'title' : title.text.replace(u'_百度百科', ''),
+          'link' : title['href'],
+          'summary' : summary.text}
+
+
+def FetchEntity(client, name):
+  """Returns (search result page, its first description or None)."""
+  response = SearchForEntityName(client, name)
+  try:
+    return response, ExtractFirstDesc(response)
+  except IndexError:
+    return response, None
+
+
+def PrepareSearchResults(connection):
+  connection.execute(
+    'create table if not exists search_results(entity_name text, response text, failed bool)')
+  # Earlier versions may have inserted an entity more than once.
+  connection.execute('delete from search_results where rowid not in '
+                     '(select max(rowid) from search_results group by entity_name)')
+  connection.execute(
+    'create unique index if not exists search_results_entity_name on search_results(entity_name)')
+  connection.commit()
+
 
 def main(argv):
   try:
@@ -126,22 +100,42 @@ def main(argv):
     sys.exit(1)
 
   e_db_loc = path.abspath(gflags.FLAGS.db_loc)
-  if not gflags.FLAGS.retry_on_failed:
-    all_entities = GetAllEntities()
-  else:
-    all_entities = GetFailedEntities(e_db_loc)
-
-  fetching_threads = [FetchingThread() for i in range(gflags.FLAGS.n_fetching_threads)]
-  writing_thread = WritingThread(e_db_loc, len(all_entities), gflags.FLAGS.retry_on_failed)
-
-  for t in fetching_threads + [writing_thread]:
-    t.start()
-  for ent in all_entities:
-    task_queue.put(ent)
-  for i in range(gflags.FLAGS.n_fetching_threads):
-    task_queue.put(None)
-  
-  writing_thread.join()
+  conn = bulk_writer.OpenDB(e_db_loc)
+  PrepareSearchResults(conn)
+  all_entities = GetAllEntities()
+  if gflags.FLAGS.retry_on_failed:
+    all_entities -= set(i[0] for i in conn.execute(
+      'select entity_name from search_results where not failed'))
+  conn.close()
+
+  baike_conn = bulk_writer.OpenDB(gflags.FLAGS.baike_db_loc)
+  baike_conn.executescript(bulk_writer.ENTITIES_SCHEMA)
+  baike_conn.close()
+
+  results_writer = bulk_writer.BulkWriter(e_db_loc, {
+    "search_results" : ("entity_name", ["entity_name", "response", "failed"])})
+  entities_writer = bulk_writer.BulkWriter(gflags.FLAGS.baike_db_loc, {
+    "entities" : ("entity_name", ["entity_name", "title", "link", "summary"])})
+  results_writer.start()
+  entities_writer.start()
+
+  client = crawler.HttpClient()
+  n_finished = 0
+  for entity_name, result, failed in crawler.Crawl(
+      sorted(all_entities), lambda name: FetchEntity(client, name)):
+    if failed:
+      results_writer.Put("search_results", (entity_name, result, True))
+    else:
+      response, desc = result
+      results_writer.Put("search_results", (entity_name, response, False))
+      if desc is not None:
+        entities_writer.Put("entities", (
+          entity_name, desc['title'], desc['link'], desc['summary']))
+    n_finished += 1
+    if n_finished % 100 == 0:
+      print "finished %d, out of %d" % (n_finished, len(all_entities))
+  results_writer.Close()
+  entities_writer.Close()
 
 if __name__ == "__main__":
   main(sys.argv)
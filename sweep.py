@@ -0,0 +1,212 @@
+"""Sweeping extractor subsets and LogisticRegression parameters.
+
+Every combination of --sweep_extractors, --sweep_C, --sweep_penalty and
+--sweep_class_weight is a configuration. Features of all the extractors are
+extracted once, and each configuration selects its columns.
+
+Configurations are compared with successive halving: all of them run the first
+--sweep_min_folds cross validation folds, then only the best 1/--sweep_eta run
+--sweep_eta times as many folds, and so on until the survivors ran all of
+--cv_folds. Survivors are also evaluated on held-out data. A configuration that
+runs all the folds gets the same cross validation result as run_experiment.py.
+
+Runs are scheduled on --sweep_workers processes, and every configuration is
+recorded in the experiments DB, with its parameters.
+
+Example:
+  python sweep.py --sweep_extractors="nchar,char;nchar,char,cont_match" \
+      --sweep_C=0.1,1,10 --sweep_penalty=l1,l2
+"""
+
+import gflags
+import itertools
+import math
+import multiprocessing
+import random
+import tabulate
+import entitydb
+import experiments
+import features
+import run_experiment
+import settings
+import tqdm
+import utils
+
+gflags.DEFINE_string("sweep_extractors", "nchar,char,nsumchar,sumchar,cont_bigram,cont_match",
+                     "Semicolon separated extractor subsets, each a comma "
+                     "separated list of extractors.")
+gflags.DEFINE_boolean("sweep_all_subsets", False,
+                      "Sweep every non-empty subset of the extractors of "
+                      "--sweep_extractors, which must list a single subset.")
+gflags.DEFINE_string("sweep_C", "1.0", "Comma separated inverse regularization strengths.")
+gflags.DEFINE_string("sweep_penalty", "l2", "Comma separated penalties, l1 or l2.")
+gflags.DEFINE_string("sweep_class_weight", "none",
+                     "Comma separated class weights, none or balanced.")
+gflags.DEFINE_integer("sweep_min_folds", 2,
+                      "Number of folds every configuration runs before the "
+                      "worst ones are stopped.")
+gflags.DEFINE_integer("sweep_eta", 3,
+                      "Only the best 1/eta configurations of a round run "
+                      "the next one, with eta times as many folds.")
+gflags.DEFINE_integer("sweep_workers", 1, "Number of processes running folds.")
+
+
+class Config(object):
+  """A configuration of the sweep.
+
+  Attributes:
+    extractors_name: comma separated extractors.
+    params: dict of LogisticRegression parameters.
+    fold_results: dict from fold to its evaluation result.
+    hd_result: evaluation on held-out data, of survivors only.
+  """
+
+  def __init__(self, extractors_name, params):
+    self.extractors_name = extractors_name
+    self.params = params
+    self.fold_results = {}
+    self.hd_result = None
+
+  def CVScore(self):
+    """Mean MAP over the subtasks and the folds run so far."""
+    return sum(result["score"] for result in self.fold_results.itervalues()) / len(
+        self.fold_results)
+
+
+def _ParseList(value):
+  return [v.strip() for v in value.split(",") if v.strip()]
+
+
+def BuildConfigs():
+  subsets = [s.strip() for s in gflags.FLAGS.sweep_extractors.split(";") if s.strip()]
+  if gflags.FLAGS.sweep_all_subsets:
+    if len(subsets) != 1:
+      raise ValueError("--sweep_all_subsets needs a single extractor list.")
+    names = _ParseList(subsets[0])
+    subsets = [",".join(c) for n in range(1, len(names) + 1)
+               for c in itertools.combinations(names, n)]
+  configs = []
+  for subset, C, penalty, class_weight in itertools.product(
+      subsets, _ParseList(gflags.FLAGS.sweep_C), _ParseList(gflags.FLAGS.sweep_penalty),
+      _ParseList(gflags.FLAGS.sweep_class_weight)):
+    configs.append(Config(subset, {
+        "C" : float(C),
+        "penalty" : penalty,
+        "class_weight" : None if class_weight == "none" else class_weight}))
+  return configs
+
+
+def FoldSchedule(n_folds, min_folds, eta):
+  """Number of folds run by the configurations of each round."""
+  schedule = [min(max(min_folds, 1), n_folds)]
+  while schedule[-1] < n_folds:
+    schedule.append(min(schedule[-1] * eta, n_folds))
+  return schedule
+
+
+_sweep_context = None
+# Table of the extractors of the last configuration a process ran. Tasks are
+# ordered by extractors, so that consecutive tasks reuse it.
+_selected_table = None
+
+
+def _RunTask((config_id, fold)):
+  """Evaluates a configuration on a fold, or on held-out data if fold is None.
+
+  Returns:
+    (config_id, fold, result)
+  """
+  global _selected_table
+  table, configs, splits = _sweep_context
+  config = configs[config_id]
+  if _selected_table is None or _selected_table.extractors_name != config.extractors_name:
+    _selected_table = table.Select(config.extractors_name)
+  cv_features, hd_features = _selected_table.datasets
+  if fold is None:
+    model = cv_features.TrainModel(config.params)
+    return config_id, fold, hd_features.Evaluate(model)
+  train_ids, test_ids = splits[fold]
+  model = cv_features.Subset(train_ids).TrainModel(config.params)
+  return config_id, fold, cv_features.Subset(test_ids).Evaluate(
+      model, seed=random.Random(fold))
+
+
+def _RunTasks(tasks, desc):
+  tasks = sorted(tasks, key=lambda (config_id, fold): (
+      _sweep_context[1][config_id].extractors_name, config_id, fold))
+  if gflags.FLAGS.sweep_workers > 1:
+    pool = multiprocessing.Pool(gflags.FLAGS.sweep_workers, entitydb.ResetAfterFork)
+    results = pool.imap_unordered(_RunTask, tasks)
+  else:
+    pool = None
+    results = itertools.imap(_RunTask, tasks)
+  for result in tqdm.tqdm(results, desc, len(tasks)):
+    yield result
+  if pool is not None:
+    pool.close()
+    pool.join()
+
+
+def RunSweep(configs, cv_data, hd_data):
+  """Runs the successive halving rounds.
+
+  Returns:
+    the configurations that ran all the folds, best first.
+  """
+  global _sweep_context
+  extractor_names = sorted(set(
+      name for c in configs for name in c.extractors_name.split(",")))
+  table = features.FeatureTable(",".join(extractor_names), cv_data, hd_data)
+  splits = list(experiments.IterCVSplits(cv_data, gflags.FLAGS.cv_folds))
+  _sweep_context = (table, configs, splits)
+
+  survivors = range(len(configs))
+  schedule = FoldSchedule(gflags.FLAGS.cv_folds, gflags.FLAGS.sweep_min_folds,
+                          gflags.FLAGS.sweep_eta)
+  for round_id, n_folds in enumerate(schedule):
+    tasks = [(c, fold) for c in survivors for fold in range(n_folds)
+             if fold not in configs[c].fold_results]
+    for config_id, fold, result in _RunTasks(
+        tasks, "Round %d: %d configurations, %d folds" % (round_id, len(survivors), n_folds)):
+      configs[config_id].fold_results[fold] = result
+    # Stable, so that ties keep the order of the grid.
+    survivors.sort(key=lambda c: -configs[c].CVScore())
+    if round_id + 1 < len(schedule):
+      survivors = survivors[:int(math.ceil(len(survivors) / float(gflags.FLAGS.sweep_eta)))]
+
+  for config_id, _, result in _RunTasks([(c, None) for c in survivors], "Held-out set"):
+    configs[config_id].hd_result = result
+  _sweep_context = None
+  return [configs[c] for c in survivors]
+
+
+def RecordConfig(config):
+  experiment = experiments.StartNewExperiment(config.extractors_name, config.params)
+  experiment.cv_result = experiments.CVReport(
+      [config.fold_results[fold] for fold in sorted(config.fold_results)])
+  experiment.RecordHeldoutDataEval(config.hd_result)
+  experiment.Save()
+  return experiment.GetID()
+
+
+def main():
+  utils.Initialize()
+  configs = BuildConfigs()
+  print "Sweeping %d configurations.\n" % len(configs)
+  cv_data = run_experiment.LoadCVData()
+  hd_data = run_experiment.LoadHDData()
+  RunSweep(configs, cv_data, hd_data)
+
+  rows = []
+  # Survivors first, as scores over fewer folds are less reliable.
+  for config in sorted(configs, key=lambda c: (-len(c.fold_results), -c.CVScore())):
+    rows.append([RecordConfig(config), config.extractors_name, config.params["C"],
+                 config.params["penalty"], config.params["class_weight"],
+                 len(config.fold_results), "%.4f" % config.CVScore(),
+                 "" if config.hd_result is None else "%.4f" % config.hd_result["score"]])
+  print tabulate.tabulate(rows, headers=[
+      "ID", "features", "C", "penalty", "class_weight", "folds", "CV MAP", "Held-out MAP"])
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,67 @@
+"""Updating a trained model with newly labeled queries.
+
+Only the features of the new queries are extracted. They are appended to the
+training matrix saved with the model, and the model is retrained, starting from
+its current coefficients.
+
+Example:
+  python update_model.py --update_model_loc=models/101.model \
+      --update_data_loc_template="data/NEW SET/{}.txt"
+"""
+
+import compactmodel
+import gflags
+import models
+import settings
+import datacache
+import timeit
+import utils
+from os import path
+
+gflags.DEFINE_string("update_model_loc", "", "Model to update.")
+gflags.DEFINE_string("update_data_loc_template", "",
+                     "Template of the new labeled data of a subtask. Later "
+                     "call .format. Subtasks without a file are skipped.")
+gflags.DEFINE_string("updated_model_loc", "",
+                     "Where to save the updated model. Defaults to updating "
+                     "--update_model_loc in place.")
+gflags.DEFINE_boolean("warm_start", True,
+                      "Start from the current coefficients, instead of fitting "
+                      "from scratch on all the training data.")
+
+
+def LoadUpdateData():
+  data = {}
+  for task in settings.sub_tasks:
+    data_loc = gflags.FLAGS.update_data_loc_template.format(task)
+    if path.isfile(data_loc):
+      data[task] = datacache.LoadData(data_loc, test_data=False)
+  return data
+
+
+def main():
+  utils.Initialize()
+  model_loc = gflags.FLAGS.update_model_loc
+  if not path.isfile(model_loc):
+    raise ValueError("Cannot find model {}".format(model_loc))
+  data = LoadUpdateData()
+  if not data:
+    raise ValueError("No data found at {}".format(gflags.FLAGS.update_data_loc_template))
+
+  model = models.LogisticModel.LoadFrom(model_loc)
+  if not isinstance(model, models.LogisticModel):
+    raise ValueError("Only a LogisticModel can be updated, not a %s" % type(model).__name__)
+  n_rows = model.X.shape[0] if model.X is not None else 0
+  start = timeit.default_timer()
+  model.Update(data, warm_start=gflags.FLAGS.warm_start)
+  print "Added %d queries, %d pairs in %.1fs. The model has %d features." % (
+      sum(len(d) for d in data.itervalues()), model.X.shape[0] - n_rows,
+      timeit.default_timer() - start, model.X.shape[1])
+
+  output_loc = gflags.FLAGS.updated_model_loc or model_loc
+  model.Save(output_loc)
+  compactmodel.Write(model, compactmodel.CompactLoc(output_loc))
+
+
+if __name__ == "__main__":
+  main()
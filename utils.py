@@ -2,6 +2,8 @@
 """
 
 import errno
+import io
+import logging
 import os
 import sys
 import gflags
@@ -21,26 +23,43 @@ def Initialize():
   try:
     argv = gflags.FLAGS(sys.argv)
   except gflags.FlagsError, e:
-    print '%s\\nUsage: %s ARGS\\n%s' % (e, sys.argv[0], FLAGS)
+    print '%s\\nUsage: %s ARGS\\n%s' % (e, sys.argv[0], gflags.FLAGS)
     sys.exit(1)
 
   
-def LoadInData(data_loc, test_data=False):
-  lines = unicode(open(data_loc).read(), 'gbk').split('\n')
-  parsing_result = []
-  for line in lines:
-    terms = line.split('\t')
-    items = []
-    for i in terms[1:]:
-      if test_data:
-        ent, score = i, None
-
-      else:
-        colon_separated = i.split(':')
-        ent = ':'.join(colon_separated[:-1])
-        score = int(colon_separated[-1])
-      items.append((ent, score))
-    if len(items) == 0:
-      continue
-    parsing_result.append((terms[0], items))
-  return parsing_result
+def IterData(data_loc, test_data=False, strict=True):
+  """Yields the (query, [(entity, score), ...]) of each line of a data file.
+
+  The file is decoded and parsed one line at a time, so it can be larger than
+  memory.
+
+  Args:
+    test_data: when set, lines list entities only, and scores are None.
+    strict: when set, a malformed entity:score raises ValueError. Otherwise it
+      is logged and skipped.
+  """
+  with io.open(data_loc, encoding='gbk', newline='\n') as infile:
+    for line_no, line in enumerate(infile, 1):
+      terms = line.rstrip('\n').split('\t')
+      items = []
+      for i in terms[1:]:
+        if test_data:
+          ent, score = i, None
+        else:
+          ent, _, score = i.rpartition(':')
+          try:
+            score = int(score)
+          except ValueError:
+            message = "%s:%d: malformed entity:score %r" % (data_loc, line_no, i)
+            if strict:
+              raise ValueError(message)
+            logging.warning(message)
+            continue
+        items.append((ent, score))
+      if len(items) == 0:
+        continue
+      yield (terms[0], items)
+
+
+def LoadInData(data_loc, test_data=False, strict=True):
+  return list(IterData(data_loc, test_data, strict))